@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+##############################################################################
+# Note: The author has placed this work in the Public Domain, thereby        #
+#       relinquishing all copyrights.  Everyone is free to use, modify,      #
+# republish, sell or give away this work without prior consent from anybody. #
+##############################################################################
+#
+# This script creates precompressed .gz variants of static web files, which
+# the uPageKite HTTPD will serve to clients that accept gzip encoding. Run
+# it on your web root before uploading it to the device:
+#
+#    $ python3 scripts/gzip_static.py webapp/webroot
+#
+# Existing .gz files are rewritten, or removed if they no longer help.
+#
+import gzip
+import os
+import sys
+
+EXTENSIONS = ('css', 'htm', 'html', 'js', 'json', 'svg', 'txt', 'xml')
+MIN_BYTES = 256
+
+
+def gzip_static(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            if fn.rsplit('.', 1)[-1].lower() not in EXTENSIONS:
+                continue
+            src = os.path.join(dirpath, fn)
+            dst = src + '.gz'
+            with open(src, 'rb') as fd:
+                data = fd.read()
+            packed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(data) < MIN_BYTES or len(packed) >= len(data):
+                if os.path.exists(dst):
+                    os.remove(dst)
+                    print('Removed %s' % dst)
+                continue
+            with open(dst, 'wb') as fd:
+                fd.write(packed)
+            st = os.stat(src)
+            os.utime(dst, (st.st_atime, st.st_mtime))
+            print('%s: %d -> %d bytes' % (dst, len(data), len(packed)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: %s /path/to/webroot [...]' % sys.argv[0])
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        gzip_static(path)
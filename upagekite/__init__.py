@@ -12,9 +12,12 @@ import gc
 import time
 import select
 
-from .proto import asyncio, socket, ticks_ms, fuzzy_sleep_ms, print_exc
-from .proto import Kite, Frame, EofTunnelError, uPageKiteDefaults
-from .proto import SELECT_POLL_IN, IS_MICROPYTHON
+from .proto import asyncio, socket, ticks_ms, ticks_add, ticks_diff
+from .proto import fuzzy_sleep_ms, print_exc
+from .proto import current_task
+from .proto import Kite, Frame, FrameScheduler, EofTunnelError, buffers_len
+from .proto import uPageKiteDefaults
+from .proto import SELECT_POLL_IN, IS_MICROPYTHON, _would_block
 
 
 try:
@@ -39,8 +42,214 @@ def _fileno(obj):
     return id(obj)
 
 
+class LocalClient:
+  """
+  A connection to our LocalHTTPKite. These live in the connection pool,
+  alongside the relay connections, so requests (and uploaded data) are
+  dispatched to handlers as they arrive.
+
+  Connections are kept alive between requests if the HTTPD asks for it
+  (see LocalHTTPKite.keep_alive()), and pipelined requests are processed
+  in order, one at a time. Idle connections time out, as do requests
+  which have no handler waiting for data and send nothing for
+  REQUEST_TIMEOUT_MS.
+  """
+  def __init__(self, kite, sid, addr):
+    self.kite = kite
+    self.sid = sid
+    self.addr = addr
+    self.fd, self.client = kite.conns[sid]
+    self.wake_pool = None
+    self.buf = b''
+    self.busy = False
+    self.keepalive = False
+    self.body_left = 0
+    self.nbytes = -1
+    self.unacked = None
+    self.resume_ms = 0
+    self.expires_ms = 0
+    self.set_timeout(kite.KEEPALIVE_MS)
+
+  def __str__(self):
+    return '<LocalClient(%s)>' % (self.sid,)
+
+  def _wake(self):
+    if self.wake_pool is not None:
+      self.wake_pool()
+
+  def set_timeout(self, ms):
+    # Zero means no deadline, so avoid it if the tick counter wraps there.
+    self.expires_ms = ticks_add(ticks_ms(), ms) or 1
+
+  def _request_len(self):
+    # Returns the length of the first buffered request (headers and
+    # as much of the body as we have), or 0 if it is still incomplete.
+    end = self.buf.find(b'\r\n\r\n')
+    if end < 0:
+      return 0
+    self.body_left = 0
+    for line in str(self.buf[:end], 'latin-1').lower().split('\r\n'):
+      if line.startswith('content-length:'):
+        self.body_left = int(line[15:].strip())
+      elif line.startswith('transfer-encoding:'):
+        self.body_left = None  # Unknown, so we cannot keep-alive
+    if self.body_left is None:
+      return len(self.buf)
+    have = min(self.body_left, len(self.buf) - (end + 4))
+    self.body_left -= have
+    return end + 4 + have
+
+  def ready(self):
+    return (not self.busy) and (b'\r\n\r\n' in self.buf)
+
+  def wants_read(self):
+    # Not reading applies back-pressure to the client, which is how we
+    # honor our rate limits without blocking anyone else.
+    if self.resume_ms and (ticks_diff(self.resume_ms, ticks_ms()) > 0):
+      return False
+    if self.busy:
+      return (self.sid in self.kite.handlers) and (
+        len(self.buf) < self.kite.MAX_READ) and (
+        (self.unacked is None) or (self.unacked < self.kite.MAX_UNACKED))
+    return True
+
+  def ack(self, nbytes):
+    # Handlers which ack what they consume (see web.RequestBody) opt in
+    # to flow control; we stop reading while too much is unacknowledged.
+    paused = not self.wants_read()
+    self.unacked = max(0, (self.unacked or 0) - nbytes)
+    if paused and self.wants_read():
+      self._wake()
+
+  def next_request(self):
+    # The reply has been sent, get ready for the next request.
+    self.busy = self.keepalive = False
+    self.nbytes = -1
+    self.unacked = None
+    self.set_timeout(self.kite.KEEPALIVE_MS)
+    self._wake()
+
+  def expire(self):
+    # While a handler is waiting for data we keep reading, so a hangup
+    # will be noticed; long-lived requests (e.g. websockets) may idle.
+    if self.busy and (self.sid in self.kite.handlers):
+      return self.set_timeout(self.kite.REQUEST_TIMEOUT_MS)
+    # A stuck request cannot be answered, we may be mid-response.
+    if self.buf and not self.busy:
+      self.abort(b'HTTP/1.0 408 Timed out\r\n\r\n')
+    else:
+      self.kite.close(self.sid)
+
+  def abort(self, response):
+    try:
+      self.fd.setblocking(True)
+      self.client.write(response)
+      if hasattr(self.client, 'flush'):
+        self.client.flush()
+    except (OSError, IOError):
+      pass
+    self.kite.close(self.sid)
+
+  def _recv(self, nbytes):
+    self.fd.setblocking(False)
+    try:
+      return self.fd.recv(nbytes)
+    except OSError as e:
+      if _would_block(e):
+        return None
+      return b''
+
+  async def process_hangup(self, uPK):
+    if self.busy and (self.sid not in self.kite.handlers):
+      self.kite.close(self.sid)
+      return True
+    return await self.process_io(uPK)
+
+  async def process_io(self, uPK):
+    try:
+      if self.busy:
+        await self._process_data(uPK)
+      else:
+        await self._process_request(uPK)
+    except Exception as e:
+      if uPK.debug and (self.sid in self.kite.conns):
+        print_exc(e)
+      self.kite.close(self.sid)
+    return True
+
+  async def _process_request(self, uPK):
+    kite, sid = self.kite, self.sid
+    if b'\r\n\r\n' not in self.buf:
+      more = self._recv(kite.MAX_READ)
+      if more is None:
+        return
+      if not more:
+        return self.expire()
+      self.buf += more
+      if uPK.trace:
+        uPK.trace('Got local request data: %s' % (more,))
+
+    req_len = self._request_len()
+    if not req_len:
+      if len(self.buf) > kite.MAX_READ:
+        self.abort(b'HTTP/1.0 400 Invalid request\r\n\r\n')
+      return
+
+    req, self.buf = self.buf[:req_len], self.buf[req_len:]
+    self.busy = True
+    self.set_timeout(kite.REQUEST_TIMEOUT_MS)
+    await kite.handler(kite, kite, Frame(uPK, payload=req, headers={
+      'SID': sid,
+      'Host': '0.0.0.0',
+      'Proto': 'http',
+      'Port': kite.listening_port,
+      'RIP': '::ffff:%s' % (self.addr[0],)}))
+
+  async def _process_data(self, uPK):
+    kite, sid = self.kite, self.sid
+    handler = kite.handlers.get(sid)
+    if handler is None:
+      return
+
+    # Once the request body has been read, anything more the client
+    # sends is a pipelined request; buffer it and only report EOF.
+    pipelined = self.keepalive and (self.body_left == 0)
+    if pipelined or (self.nbytes <= 0):
+      more = self._recv(kite.MAX_READ)
+    else:
+      more = self._recv(min(kite.MAX_READ, self.nbytes))
+    if more is None:
+      return
+
+    self.set_timeout(kite.REQUEST_TIMEOUT_MS)
+    if more and pipelined:
+      self.buf += more
+    else:
+      if self.body_left:
+        self.body_left = max(0, self.body_left - len(more))
+      if self.unacked is not None:
+        self.unacked += len(more)
+      if self.nbytes > 0:
+        self.nbytes -= len(more)
+        if (self.nbytes <= 0) and (kite.handlers.get(sid) is handler):
+          del kite.handlers[sid]
+      await handler(Frame(uPK, payload=more, headers={
+        'SID': sid,
+        'EOF': '1WR' if (not more) else ''}))
+    if not more:
+      kite.close(sid)
+      return
+
+    pause = uPK.rate_limit_ms(len(more), (
+      kite.limiters.get(sid), kite.limiter))
+    self.resume_ms = (ticks_add(ticks_ms(), pause) or 1) if pause else 0
+
+
 class LocalHTTPKite(Kite):
   MAX_READ = (2 if IS_MICROPYTHON else 64) * 1024
+  MAX_UNACKED = (4 if IS_MICROPYTHON else 256) * 1024
+  KEEPALIVE_MS = (2 if IS_MICROPYTHON else 15) * 1000
+  REQUEST_TIMEOUT_MS = 60 * 1000
 
   def __init__(self, listen_on, name, secret, handler):
     Kite.__init__(self, name, secret, 'http', handler)
@@ -60,11 +269,25 @@ class LocalHTTPKite(Kite):
     else:
       self.fd = listen_on
     self.conns = {}
+    self.limiters = {}
+    self.clients = {}
+    self.pool = None
 
   def __str__(self):
     return '<LocalHTTPKite(%s://%s):%d>' % (
       self.proto, self.name, self.listening_port)
 
+  def keep_alive(self, frame):
+    """
+    Request that the connection be kept open once this reply is done.
+    Returns False if that is impossible, e.g. the request body is unread.
+    """
+    client = self.clients.get(frame.sid)
+    if (client is None) or (client.body_left != 0):
+      return False
+    client.keepalive = True
+    return True
+
   def sync_reply(self, frame, data=None, eof=True):
     try:
       sock, client = self.conns[frame.sid]
@@ -74,7 +297,11 @@ class LocalHTTPKite(Kite):
           frame.uPK.error(
             '**BUG?**  sync_reply(sid=%s), no conn found.' % frame.sid)
         raise
+    keepalive = False
+    lc = self.clients.get(frame.sid)
     if data:
+      if lc is not None:
+        lc.set_timeout(self.REQUEST_TIMEOUT_MS)
       data = bytes(data, 'latin-1') if (isinstance(data, str)) else data
       sock.setblocking(True)
       try:
@@ -84,22 +311,50 @@ class LocalHTTPKite(Kite):
       except (OSError, IOError) as e:
         # Assume just this connection is broken, trigger cleanup logic.
         eof = True
+        keepalive = None
         if frame.uPK.debug:
           frame.uPK.debug('Closing %s, write failed: %s' % (frame.sid, e))
     if eof:
-      if frame.sid in self.handlers:
-        del self.handlers[frame.sid]
-      if frame.sid in self.conns:
-        del self.conns[frame.sid]
+      if lc and lc.keepalive and (keepalive is not None) and (lc.body_left == 0):
+        if frame.sid in self.handlers:
+          del self.handlers[frame.sid]
+        lc.next_request()
+        return
+      self._forget(frame.sid)
       try:
         client.close()
       except:
         pass
 
+  def _forget(self, sid):
+    if sid in self.handlers:
+      del self.handlers[sid]
+    if sid in self.conns:
+      del self.conns[sid]
+    if sid in self.limiters:
+      del self.limiters[sid]
+    client = self.clients.pop(sid, None)
+    if client is not None and self.pool is not None:
+      self.pool.remove(client)
+
+  async def await_send_window(self, sid):
+    # Local sockets have no SKB acks; the socket itself is our window.
+    pass
+
+  def ack_data(self, sid, nbytes):
+    client = self.clients.get(sid)
+    if client is not None:
+      client.ack(nbytes)
+
+  def set_compression(self, sid, compress=True):
+    # Compression is a tunnel feature, local sockets are sent as-is.
+    pass
+
   async def reply(self, frame, data=None, eof=True):
+    limiters = (self.limiters.get(frame.sid), self.limiter)
     await fuzzy_sleep_ms()
     self.sync_reply(frame, data=data, eof=eof)
-    await frame.uPK.network_send_sleep(len(data))
+    await frame.uPK.network_send_sleep(len(data or ''), limiters)
 
   def await_data(self, uPK, sid, handler, nbytes=-1):
     async def async_handler(*args):
@@ -107,59 +362,17 @@ class LocalHTTPKite(Kite):
     self.async_await_data(uPK, sid, async_handler, nbytes=-1)
 
   def async_await_data(self, uPK, sid, handler, nbytes=-1):
-    # FIXME: We should be using asyncio sockets here, or add to our own
-    #        event loop instead of this ugly hack. But it works, so...
-    async def async_wait_job(nbytes):
-      sock = client = None
-      try:
-        sock, client = self.conns[sid]
-        poller = select.poll()
-        poller.register(sock)
-        while nbytes and (sid in self.handlers):
-          readable = error = False
-          for (obj, ev) in poller.poll(1):
-            if (ev & SELECT_POLL_IN):
-              readable = True
-            if ev - (ev & (SELECT_POLL_IN|select.POLLOUT)):
-              error = True
-          uPK.GC_COLLECT()
-          if readable:
-            sock.setblocking(False)
-            more = client.read(
-              min(self.MAX_READ, nbytes if (nbytes > 0) else self.MAX_READ))
-            await handler(Frame(uPK, payload=more, headers={
-              'SID': sid,
-              'EOF': '1WR' if (not more) else ''}))
-            if more:
-              if nbytes > 0:
-                nbytes -= len(more)
-              await uPK.network_send_sleep(len(more))
-            else:
-              break
-          elif error:
-            break
-          else:
-            await fuzzy_sleep_ms(50)
-      except Exception as e:
-        if uPK.debug and (sid in self.conns):
-          print_exc(e)
-      finally:
-        if sid in self.handlers:
-          del self.handlers[sid]
-        if sid in self.conns:
-          del self.conns[sid]
-        if client:
-          client.close()
-    self.handlers[sid] = True
-    asyncio.get_event_loop().create_task(async_wait_job(nbytes))
+    client = self.clients.get(sid)
+    if client is None:
+      return
+    self.handlers[sid] = handler
+    client.nbytes = nbytes
+    client._wake()
 
   def close(self, sid=None):
     for _sid in ([sid] if (sid is not None) else list(self.conns.keys())):
       sock, client = self.conns.get(_sid, (None, None))
-      if _sid in self.handlers:
-        del self.handlers[_sid]
-      if _sid in self.conns:
-        del self.conns[_sid]
+      self._forget(_sid)
       if client is not None:
         client.close()
       elif sock is not None:
@@ -167,64 +380,32 @@ class LocalHTTPKite(Kite):
     if sid is None:
       self.handlers = {}
       self.conns = {}
+      self.limiters = {}
+      self.clients = {}
       self.fd.close()
 
   async def process_io(self, uPK):
-    sid = sock = client = None
     try:
       sock, addr = self.fd.accept()
     except OSError as e:
       print_exc(e)
       return True
 
-    try:
-      sid = '%s-%x' % (_fileno(sock), ticks_ms())
-      if hasattr(sock, 'makefile'):
-        client = sock.makefile('rwb')
-      else:
-        client = sock
-      self.conns[sid] = (sock, client)
-
-      if uPK.trace:
-        uPK.trace('Reading request from: %s' % (addr,))
-      sock.setblocking(False)
-      req = b''
-      deadline = ticks_ms() + 500  # When to give up on data
-      sleep_t = 20
-      while (ticks_ms() < deadline) and (b'\r\n\r\n' not in req):
-        await fuzzy_sleep_ms(min(sleep_t, 50))
-        sleep_t += 5
-        try:
-          data = client.read(2048)
-          if data is not None:
-            req += data
-        except socket.error:
-          pass
-
-      if uPK.trace:
-        uPK.trace('Got local request: %s' % (req,))
-      if b'\r\n\r\n' in req:
-        await self.handler(self, self, Frame(uPK, payload=req, headers={
-          'SID': sid,
-          'Host': '0.0.0.0',
-          'Proto': 'http',
-          'Port': self.listening_port,
-          'RIP': '::ffff:%s' % (addr[0],)}))
-        sid = None  # Avoid the close below
-      else:
-        client.write(b'HTTP/1.0 408 Timed out\r\n\r\n')
-
-    except KeyboardInterrupt:
-      raise
-    except Exception as e:
-      print_exc(e)
-      print('Oops, process_io: %s' % e)
-      return False
-    finally:
-      if sid:
-        self.close(sid)
+    sid = '%s-%x' % (_fileno(sock), ticks_ms())
+    if hasattr(sock, 'makefile'):
+      client = sock.makefile('wb')
+    else:
+      client = sock
+    self.conns[sid] = (sock, client)
+    self.limiters[sid] = uPK.make_rate_limiter(uPK.LOCAL_BYTES_PER_SEC)
+    self.clients[sid] = lc = LocalClient(self, sid, addr)
+    if self.pool is not None:
+      self.pool.add(lc)
+    if uPK.trace:
+      uPK.trace('Accepted local connection from: %s' % (addr,))
 
-    return True
+    # Requests often arrive right away, save a trip through the poller.
+    return await lc.process_io(uPK)
 
 
 class myLock:
@@ -244,6 +425,12 @@ class myLock:
 class uPageKiteConn:
   def __init__(self, pk):
     self.pk = pk
+    self.reader = None
+    self.wake_pool = None
+    self.windows = {}
+    self.received = {}
+    self.zsids = {}
+    self.scheduler = FrameScheduler(pk.uPK.SCHEDULER_QUANTUM)
     try:
       self.lock = asyncio.Lock()
     except:
@@ -257,37 +444,205 @@ class uPageKiteConn:
     self.last_data_ts = now
     self.last_handle_ts = now
     self.handlers = {}
+    self.windows = {}
+    self.received = {}
+    self.zsids = {}
+    self.scheduler = FrameScheduler(pk.uPK.SCHEDULER_QUANTUM)
     return self
 
   def __str__(self):
     return "<uPageKiteConn(%s)=%s>" % (self.ip, _fileno(self.fd))
 
+  def kite_for(self, frame):
+    for kite in self.pk.kites:
+      if kite.name == frame.host:
+        return kite
+    return None
+
+  def ready(self):
+    return (self.conn is not None) and self.conn.ready()
+
+  def wants_write(self):
+    return (self.conn is not None) and (
+      self.conn.wants_write() or self.scheduler.pending)
+
+  def _pump(self):
+    # Feed the TunnelStream from our scheduler, keeping its queue short
+    # so control frames and quiet streams never wait behind bulk data.
+    conn = self.conn
+    window = self.pk.uPK.SEND_WINDOW_BYTES
+    zmin = self.pk.uPK.COMPRESS_MIN_BYTES
+    while True:
+      while conn.wbytes < window:
+        item = self.scheduler.next()
+        if item is None:
+          break
+        sid, data = item
+        if sid in self.zsids:
+          # Compression happens here, so it matches the order on the wire.
+          if not isinstance(data, list):
+            del self.zsids[sid]  # Only EOFs are not lists
+          elif conn.deflate and len(data[-1]) >= zmin:
+            conn.queue_zchunk(data[1:])
+            continue
+        conn.queue_write(data)
+      if not conn.flush_writes():
+        # Make sure the pool notices we are waiting for POLLOUT.
+        if self.wake_pool is not None:
+          self.wake_pool()
+        return
+      if not self.scheduler.pending:
+        return
+
+  async def _send_wait(self, sid, nbytes, kite):
+    # Apply rate limits and wait for our stream's backlog to drain; other
+    # streams and the tunnel reader keep running meanwhile. Sleeping before
+    # we pump lets frames queued by others this tick share our write.
+    uPK = self.pk.uPK
+    await uPK.network_send_sleep(nbytes,
+      (self.conn and self.conn.limiter, kite and kite.limiter))
+    if self.conn is not None:
+      self._pump()
+    while (self.conn is not None
+        and self.scheduler.queued_for(sid) > uPK.SEND_QUEUE_BYTES):
+      await fuzzy_sleep_ms(5)
+      self._pump()
+
+  def process_writes(self):
+    try:
+      self._pump()
+      return True
+    except (OSError, IOError) as e:
+      if self.pk.uPK.debug:
+        self.pk.uPK.debug('Write to %s failed: %s' % (self, e))
+      return False
+
+  def set_compression(self, sid, compress=True):
+    """
+    Request (or cancel) compression of data sent on a given stream. This
+    has no effect unless the relay supports compression.
+    """
+    if compress and self.conn is not None and self.conn.deflate:
+      self.zsids[sid] = True
+    elif sid in self.zsids:
+      del self.zsids[sid]
+
+  def keep_alive(self, frame):
+    # Streams end with an EOF, connection reuse is up to the relay.
+    return False
+
+  def _sent(self, sid, nbytes):
+    if sid in self.windows:
+      self.windows[sid][0] += nbytes
+    else:
+      self.windows[sid] = [nbytes, None]
+
+  def _forget_window(self, sid):
+    if sid in self.windows:
+      del self.windows[sid]
+    if sid in self.received:
+      del self.received[sid]
+
+  def ack_data(self, sid, nbytes):
+    """
+    Report that a handler has consumed nbytes of uploaded data, so the
+    relay can throttle the upload (SKB acks, in kB). Acks are batched,
+    one every RECV_ACK_BYTES.
+    """
+    received = self.received.get(sid)
+    if received is None:
+      received = self.received[sid] = [0, 0]
+    received[0] += nbytes
+    if received[0] - received[1] >= self.pk.uPK.RECV_ACK_BYTES:
+      received[1] = received[0]
+      self.scheduler.add_control(self.pk.uPK.fmt_skb(sid, received[0]))
+      self._pump()
+
+  def ack_progress(self, frame):
+    # Relays report (in SKB headers) how many kB of each stream they have
+    # delivered to the remote end. Only track streams we are sending on.
+    if frame.sid in self.windows:
+      if frame.eof:
+        self._forget_window(frame.sid)
+      elif frame.skb:
+        try:
+          self.windows[frame.sid][1] = 1024 * int(frame.skb)
+        except ValueError:
+          pass
+
+  async def await_send_window(self, sid):
+    """
+    Wait until the relay has acknowledged enough of the data sent on this
+    stream, so at most STREAM_WINDOW_BYTES are in flight. Streams where
+    the relay never sent an SKB ack are not throttled.
+    """
+    if current_task() is self.reader:
+      # Waiting would deadlock, as we are the task which reads the acks.
+      return
+    window = self.pk.uPK.STREAM_WINDOW_BYTES
+    while self.conn is not None:
+      sent_acked = self.windows.get(sid)
+      if ((not sent_acked)
+          or (sent_acked[1] is None)
+          or (sent_acked[0] - sent_acked[1] <= window)):
+        return
+      # Make sure what we have queued goes out, or no acks will come.
+      self._pump()
+      await fuzzy_sleep_ms(20)
+
+  def _payload(self, data):
+    # Payloads are queued by reference, so anything the caller might
+    # modify later gets copied (once) here. Slicing the memoryview of
+    # the result is free.
+    if isinstance(data, str):
+      data = bytes(data, 'utf-8')
+    elif not isinstance(data, bytes):
+      data = bytes(data)
+    return memoryview(data)
+
   def sync_reply(self, frame, data=None, eof=True):
     uPK = self.pk.uPK
     if data:
+      data = self._payload(data)
       chunk_size = min(2048, uPK.SEND_WINDOW_BYTES - 12)
       for chunk in range(0, len(data), chunk_size):
-        uPK.sync_send(
-          self.conn,
-          uPK.fmt_data(frame, data[chunk:chunk+chunk_size]))
+        self.scheduler.add(frame.sid,
+          uPK.fmt_data_parts(frame, data[chunk:chunk+chunk_size]))
+      self._sent(frame.sid, len(data))
     if eof:
-      uPK.sync_send(self.conn, uPK.fmt_eof(frame))
+      self.scheduler.add_eof(frame.sid, uPK.fmt_eof(frame))
+      self._forget_window(frame.sid)
+    self._pump()
 
   async def reply(self, frame, data=None, eof=True):
+    # Note: Frames are queued whole, so concurrent replies on different
+    #       streams cannot corrupt each other and need no locking.
     uPK = self.pk.uPK
-    async with self.lock:
-      if data:
-        chunk_size = min(2048, uPK.SEND_WINDOW_BYTES - 12)
-        for chunk in range(0, len(data), chunk_size):
-          await uPK.send(
-            self.conn,
-            uPK.fmt_data(frame, data[chunk:chunk+chunk_size]))
-      if eof:
-        await uPK.send(self.conn, uPK.fmt_eof(frame))
+    kite = self.kite_for(frame)
+    queued = 0
+    if data:
+      data = self._payload(data)
+      chunk_size = min(2048, uPK.SEND_WINDOW_BYTES - 12)
+      for chunk in range(0, len(data), chunk_size):
+        await self.await_send_window(frame.sid)
+        data_frame = uPK.fmt_data_parts(frame, data[chunk:chunk+chunk_size])
+        self.scheduler.add(frame.sid, data_frame)
+        self._sent(frame.sid, min(chunk_size, len(data) - chunk))
+        queued += buffers_len(data_frame)
+        if self.scheduler.queued_for(frame.sid) > uPK.SEND_QUEUE_BYTES:
+          await self._send_wait(frame.sid, queued, kite)
+          queued = 0
+    if eof:
+      # The EOF rides along with the data, in the same write if possible.
+      eof_frame = uPK.fmt_eof(frame)
+      self.scheduler.add_eof(frame.sid, eof_frame)
+      self._forget_window(frame.sid)
+      queued += len(eof_frame)
+    await self._send_wait(frame.sid, queued, kite)
 
   async def send_ping(self):
-    async with self.lock:
-      await self.pk.uPK.send(self.conn, self.pk.uPK.fmt_ping())
+    self.scheduler.add_control(self.pk.uPK.fmt_ping())
+    self._pump()
 
   def await_data(self, uPK, sid, handler, nbytes=-1):
     async def async_handler(*args):
@@ -300,6 +655,10 @@ class uPageKiteConn:
   def close(self, sid=None):
     if not sid:
       self.handlers = {}
+      self.windows = {}
+      self.received = {}
+      self.zsids = {}
+      self.scheduler = FrameScheduler(self.pk.uPK.SCHEDULER_QUANTUM)
       if self.conn is not None:
         self.conn.close()
         self.conn = None
@@ -310,54 +669,28 @@ class uPageKiteConn:
       # FIXME: Send EOF over tunnel?
       if sid in self.handlers:
         del self.handlers[sid]
+      if sid in self.zsids:
+        del self.zsids[sid]
+      self._forget_window(sid)
 
   async def process_io(self, uPK):
+    self.reader = current_task()
     try:
-      async with self.lock:
-        frame = await self.pk.uPK.read_chunk(self.conn)
-      now = int(time.time())
-      self.last_data_ts = now
-      if frame:
-        frame = Frame(uPK, frame, cid=('%d-' % id(self.fd)))
-
-        if frame.ping:
-          async with self.lock:
-            # Should never happen, as we send our own pings much more frequently
-            await self.pk.uPK.send(self.conn, self.pk.uPK.fmt_pong(frame.ping))
-
-        elif frame.sid and frame.sid in self.handlers:
-          try:
-            self.last_handle_ts = now
-            await self.handlers[frame.sid](frame)
-          except Exception as e:
-            print_exc(e)
-            if self.pk.uPK.debug:
-              self.pk.uPK.debug('Oops, sid handler: %s' % e)
-            await self.reply(frame, eof=True)
-            if frame.sid in self.handlers:
-              del self.handlers[frame.sid]
-
-        elif frame.sid and frame.host and frame.proto:
-          p_p = '%s-%s' % (frame.proto, frame.port)
-          for kite in self.pk.kites:
-            if kite.name == frame.host and kite.proto in (p_p, frame.proto):
-              # FIXME: We should allow the handler to return a callback
-              #        for any subsequent data with the same SID, to
-              #        allow for uploads or bidirectional comms.
-              self.last_handle_ts = now
-              await kite.handler(kite, self, frame)
-              break
-
-        elif frame.sid and frame.skb and not frame.eof:
-          # Just ignore these, so as not to prematurely kill in-flight streams
-          pass
-
-        elif frame.sid:
-          if self.pk.uPK.debug:
-            self.pk.uPK.debug('Fell through, closing tunnel')
-          await self.reply(frame, eof=True)
-
-        # FIXME: Detect and report quota values? Other things?
+      # Process every chunk we have buffered, not just the first one, as
+      # the poller will not tell us about data that was already read.
+      while True:
+        async with self.lock:
+          frame = await self.pk.uPK.read_chunk(self.conn)
+          now = int(time.time())
+          self.last_data_ts = now
+          if len(frame):
+            frame = Frame(uPK, frame, cid=('%d-' % id(self.fd)))
+          else:
+            frame = None
+        if frame:
+          await self.process_frame(frame, now)
+        if not self.conn.ready():
+          break
 
       # Zero-length chunks aren't an error condition
       return True
@@ -366,29 +699,225 @@ class uPageKiteConn:
         self.pk.uPK.debug('EOF tunnel %s(%s)' % (type(e), e))
       return False
 
+  async def process_frame(self, frame, now):
+    self.ack_progress(frame)
+    if frame.ping:
+      # Should never happen, as we send our own pings much more frequently
+      self.scheduler.add_control(self.pk.uPK.fmt_pong(frame.ping))
+      self._pump()
+
+    elif frame.sid and frame.sid in self.handlers:
+      try:
+        self.last_handle_ts = now
+        await self.handlers[frame.sid](frame)
+      except Exception as e:
+        print_exc(e)
+        if self.pk.uPK.debug:
+          self.pk.uPK.debug('Oops, sid handler: %s' % e)
+        await self.reply(frame, eof=True)
+        if frame.sid in self.handlers:
+          del self.handlers[frame.sid]
+
+    elif frame.sid and frame.host and frame.proto:
+      p_p = '%s-%s' % (frame.proto, frame.port)
+      for kite in self.pk.kites:
+        if kite.name == frame.host and kite.proto in (p_p, frame.proto):
+          # FIXME: We should allow the handler to return a callback
+          #        for any subsequent data with the same SID, to
+          #        allow for uploads or bidirectional comms.
+          self.last_handle_ts = now
+          await kite.handler(kite, self, frame)
+          break
+
+    elif frame.sid and frame.skb and not frame.eof:
+      # Just ignore these, so as not to prematurely kill in-flight streams
+      pass
+
+    elif frame.sid:
+      if self.pk.uPK.debug:
+        self.pk.uPK.debug('Fell through, closing tunnel')
+      await self.reply(frame, eof=True)
+
+    # FIXME: Detect and report quota values? Other things?
+
 
 class uPageKiteConnPool:
+  """
+  The set of sockets we are watching for events. This is long-lived;
+  relay connections are added and removed as they come and go, see
+  sync(). Connections must be removed before they are closed.
+  """
   def __init__(self, conns, pk):
     self.pk = pk
+    self.conns = {}
+    self.fds = {}
+    self.masks = {}
+    self.paused = False
+    self.expires_ms = 0
+    self.poll = select.poll()
+    self.loop = self.wakeup = None
+    if pk.uPK.EVENT_DRIVEN_IO:
+      self.watch()
+    self.sync(conns)
+
+  def watch(self):
+    # Have the asyncio event loop tell us when our sockets are ready,
+    # instead of polling. Unavailable on MicroPython and some platforms,
+    # in which case we silently fall back to polling.
+    try:
+      self.loop = asyncio.get_event_loop()
+      self.wakeup = asyncio.Event()
+      for fno, conn in self.conns.items():
+        self._watch(fno, conn)
+        if self.wakeup is None:
+          break
+    except AttributeError:
+      self.unwatch()
+
+  def _watch(self, fno, conn):
+    try:
+      self.loop.add_reader(fno, self.wakeup.set)
+      if hasattr(conn, 'wake_pool'):
+        conn.wake_pool = self.wakeup.set
+    except NotImplementedError:
+      self.unwatch()
 
-    self.conns = dict((_fileno(c.fd), c) for c in conns)
-    for so in pk.socks:
+  def _unwatch(self, fno, conn):
+    try:
+      self.loop.remove_reader(fno)
+      self.loop.remove_writer(fno)
+    except NotImplementedError:
+      pass  # Nothing was registered, see _watch()
+    if hasattr(conn, 'wake_pool'):
+      conn.wake_pool = None
+
+  def unwatch(self):
+    if self.wakeup is not None:
+      for fno, conn in self.conns.items():
+        self._unwatch(fno, conn)
+      self.loop = self.wakeup = None
+
+  def add(self, conn):
+    fno = _fileno(conn.fd)
+    if self.conns.get(fno) is conn:
+      return
+    self.conns[fno] = conn
+    self.fds[fno] = conn.fd
+    self.masks[fno] = select.POLLIN
+    self.poll.register(conn.fd, select.POLLIN)
+    if hasattr(conn, 'pool'):
+      conn.pool = self
+    if self.wakeup is not None:
+      self._watch(fno, conn)
+
+  def remove(self, conn):
+    for fno, c in list(self.conns.items()):
+      if c is conn:
+        # The socket may be closed already, so we unregister using the
+        # file number we saved (or the object itself, on MicroPython).
+        fd = self.fds.pop(fno)
+        del self.conns[fno]
+        del self.masks[fno]
+        try:
+          self.poll.unregister(fno if hasattr(fd, 'fileno') else fd)
+        except (KeyError, ValueError, OSError):
+          pass
+        if hasattr(conn, 'pool'):
+          conn.pool = None
+        if self.wakeup is not None:
+          self._unwatch(fno, conn)
+
+  def sync(self, conns):
+    """
+    Make the pool watch exactly the given relay connections, along with
+    any local sockets of our uPageKite (and their clients).
+    """
+    wanted = list(conns)
+    for so in self.pk.socks:
       if so.fd is not None:
-        self.conns[_fileno(so.fd)] = so
+        wanted.append(so)
+        wanted.extend(getattr(so, 'clients', {}).values())
+    for conn in list(self.conns.values()):
+      if conn not in wanted:
+        self.remove(conn)
+    for conn in wanted:
+      self.add(conn)
+    return self
 
-    self.poll = select.poll()
-    for fno in self.conns:
-      self.poll.register(self.conns[fno].fd, select.POLLIN)
+  def close(self):
+    """
+    Stop watching all sockets. This does not close them.
+    """
+    self.unwatch()
+    for conn in list(self.conns.values()):
+      self.remove(conn)
+
+  def update_masks(self):
+    # Only ask for POLLOUT while there is queued data, or we would spin.
+    # Sockets may also ask us to stop reading for a while, or have timers.
+    self.paused = False
+    self.expires_ms = 0
+    for fno, conn in self.conns.items():
+      expires_ms = getattr(conn, 'expires_ms', 0)
+      if expires_ms and (not self.expires_ms
+          or ticks_diff(expires_ms, self.expires_ms) < 0):
+        self.expires_ms = expires_ms
+      mask = select.POLLIN
+      if hasattr(conn, 'wants_read') and not conn.wants_read():
+        mask = 0
+        self.paused = True
+      if hasattr(conn, 'wants_write') and conn.wants_write():
+        mask |= select.POLLOUT
+      old_mask = self.masks.get(fno, 0)
+      if old_mask != mask:
+        self.poll.modify(conn.fd, mask)
+        self.masks[fno] = mask
+        if self.wakeup is not None:
+          if (old_mask ^ mask) & select.POLLIN:
+            if mask & select.POLLIN:
+              self.loop.add_reader(fno, self.wakeup.set)
+            else:
+              self.loop.remove_reader(fno)
+          if (old_mask ^ mask) & select.POLLOUT:
+            if mask & select.POLLOUT:
+              self.loop.add_writer(fno, self.wakeup.set)
+            else:
+              self.loop.remove_writer(fno)
+
+  def buffered_events(self):
+    # Data already sitting in our read buffers will not wake the poller.
+    return [(c.fd, select.POLLIN) for c in self.conns.values()
+      if hasattr(c, 'ready') and c.ready()]
 
   async def async_poll(self, timeout_ms):
-    deadline = ticks_ms() + timeout_ms
-    while ticks_ms() < deadline:
-      events = self.poll.poll(1)
+    deadline = ticks_add(ticks_ms(), timeout_ms)
+    while ticks_diff(deadline, ticks_ms()) > 0:
+      self.update_masks()
+      events = (self.buffered_events()
+        or self.poll.poll(0 if (self.wakeup is not None) else 1))
       if events:
         if self.pk.uPK.trace:
           self.pk.uPK.trace('poll() returned: %s' % (events,))
         return events
-      await fuzzy_sleep_ms(min(75, deadline - ticks_ms()))
+      if self.expires_ms and (ticks_diff(self.expires_ms, ticks_ms()) <= 0):
+        break
+      if self.wakeup is not None:
+        # Nothing happens between the poll() and clear(), so we cannot
+        # miss an event. Readiness callbacks are level-triggered anyway.
+        # Paused sockets need to be rechecked, we get no event for them.
+        self.wakeup.clear()
+        timeout_ms = max(0, ticks_diff(deadline, ticks_ms()))
+        if self.paused:
+          timeout_ms = min(timeout_ms, 50)
+        if self.expires_ms:
+          timeout_ms = max(0, min(timeout_ms,
+            ticks_diff(self.expires_ms, ticks_ms())))
+        try:
+          await asyncio.wait_for(self.wakeup.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+          pass
+      else:
+        await fuzzy_sleep_ms(min(75, ticks_diff(deadline, ticks_ms())))
     return []
 
   async def process_io(self, uPK, timeout_ms):
@@ -397,20 +926,32 @@ class uPageKiteConnPool:
       self.pk.uPK.trace('Entering poll(%d)' % timeout_ms)
 
     for (obj, event) in await self.async_poll(timeout_ms):
-      conn = self.conns[obj if (type(obj) == int) else _fileno(obj)]
+      conn = self.conns.get(obj if (type(obj) == int) else _fileno(obj))
+      if conn is None:
+        continue  # Removed while we were busy with something else
       if self.pk.uPK.trace:
         self.pk.uPK.trace(
           'process_io(%s) o=%s ev=0x%x' % (conn, obj, event))
+      if event & select.POLLOUT:
+        if not conn.process_writes():
+          return False
       if (event & SELECT_POLL_IN):
         if await conn.process_io(uPK):
           count += 1
         else:
           self.pk.uPK.debug('conn.process_io() returned False')
           return False
-      elif event & select.POLLOUT:
-        pass
-      else:
-        return False
+      elif not (event & select.POLLOUT):
+        hangup = getattr(conn, 'process_hangup', None)
+        if hangup is None:
+          return False
+        await hangup(uPK)
+
+    now_ms = ticks_ms()
+    for conn in list(self.conns.values()):
+      expires_ms = getattr(conn, 'expires_ms', 0)
+      if expires_ms and (ticks_diff(expires_ms, now_ms) <= 0):
+        conn.expire()
 
     if count == 0:
       dead = int(time.time()) - max(
@@ -436,12 +977,24 @@ class uPageKite:
     self.public = public
     self.kites = kites
     self.socks = [s for s in socks if s.fd is not None]
+    for kite in kites:
+      kite.limiter = uPK.make_rate_limiter(uPK.KITE_BYTES_PER_SEC)
     self.secret = uPK.make_random_secret([(k.name, k.secret) for k in kites])
     self.want_dns_update = [0]
     self.reconfig_flag = False
+    self.pool = None
 
   def get_conn_pool(self, conns):
-    return uPageKiteConnPool(conns, self)
+    if self.pool is None:
+      self.pool = uPageKiteConnPool(conns, self)
+    return self.pool.sync(conns)
+
+  def close_conn(self, conn):
+    # Sockets must leave the pool before they are closed, or the file
+    # number may be reused while we are still watching it.
+    if self.pool is not None:
+      self.pool.remove(conn)
+    conn.close()
 
   def reconfigure(self):
     """
@@ -560,7 +1113,7 @@ class uPageKite:
     # We've fallen through to our unhappy ending, clean up
     for conn in conns:
       try:
-        conn.close()
+        self.close_conn(conn)
       except Exception as e:
         if self.uPK.debug:
           self.uPK.debug("Oops, close(%s): %s" % (conn, e))
@@ -625,7 +1178,7 @@ class uPageKite:
           for r in idle:
             if self.uPK.info:
               self.uPK.info("Disconnecting from relay: %s" % r)
-            r.close()
+            self.close_conn(r)
 
     if recheck_max < self.want_dns_update[0] < now:
       if await self.uPK.update_dns(self.want_dns_update[1], self.kites):
@@ -690,13 +1243,17 @@ class uPageKite:
             # We had a working connection, it broke! Reconnect ASAP.
             next_check = now
             for conn in relays:
-              conn.close()
+              self.close_conn(conn)
             relays = []
       else:
         if self.uPK.debug:
           self.uPK.debug("No sockets available, sleeping until %d" % next_check)
         await fuzzy_sleep_ms(999 * max(0, next_check - int(time.time())))
 
+    if self.pool is not None:
+      self.pool.close()
+      self.pool = None
+
   def run(self):
     loop = asyncio.get_event_loop()
     try:
@@ -14,17 +14,44 @@ import time
 import json
 
 from .proto import print_exc, asyncio, ilistdir, upk_open, fuzzy_sleep_ms
-from .proto import PermissionError
+from .proto import PermissionError, ticks_ms, ticks_diff
 
 try:
   from uos import stat
   def size(fn):
     return stat(fn)[6]
 except ImportError:
+  from os import stat
   from os.path import getsize as size
 
+def mtime(fn):
+  return stat(fn)[8]
+
+try:
+  from ucollections import OrderedDict
+except ImportError:
+  from collections import OrderedDict
+
+try:
+  compile
+  HAVE_COMPILE = True
+except NameError:
+  HAVE_COMPILE = False
+
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# Format a timestamp as an RFC 7231 HTTP-date
+def http_date(ts):
+  y, mo, d, h, mi, s, wd = time.gmtime(ts)[:7]
+  return '%s, %02d %s %d %02d:%02d:%02d GMT' % (
+    _DAYS[wd], d, _MONTHS[mo-1], y, h, mi, s)
+
 
 _HANDLERS = {}
+_ROUTES = {}
 
 _MIMETYPES = {
   'css': 'text/css',
@@ -48,11 +75,66 @@ def register_mime_extensions(**kwargs):
     _MIMETYPES[str(k).lower()] = kwargs[k]
 
 
-# Decorator for registering functions as URL handlers
+# Add a parameterized or prefix route to the trie. Each node is a dict
+# mapping path segments to child nodes; '<>' is the child for a <param>
+# segment, '*' holds a prefix handler and None the handler for the node
+# itself. Parameter names live with the handler, so routes may share
+# parameter positions without sharing names.
+def _add_route(path, handler):
+  node, names = _ROUTES, []
+  segs = [s for s in path.split('/') if s]
+  for i, seg in enumerate(segs):
+    if seg == '*':
+      if i != len(segs) - 1:
+        raise ValueError('Wildcards must end the path: %s' % path)
+      node['*'] = (handler, names)
+      return
+    if seg[:1] == '<' and seg[-1:] == '>':
+      names.append(seg[1:-1])
+      seg = '<>'
+    node = node.setdefault(seg, {})
+  node[None] = (handler, names)
+
+
+# Find the handler for a path, preferring exact segments over parameters
+# and falling back to the longest prefix route. If a more specific branch
+# fails to match further down, we backtrack and try the others.
+def _match_route(node, segs, i, values):
+  if i < len(segs):
+    seg = segs[i]
+    if (seg in node) and (seg not in ('*', '<>')):
+      found = _match_route(node[seg], segs, i+1, values)
+      if found is not None:
+        return found
+    if '<>' in node:
+      found = _match_route(node['<>'], segs, i+1, values + [seg])
+      if found is not None:
+        return found
+  elif None in node:
+    (handler, names) = node[None]
+    return handler, dict(zip(names, values))
+  if '*' in node:
+    (handler, names) = node['*']
+    params = dict(zip(names, values))
+    params['*'] = '/'.join(segs[i:])
+    return handler, params
+  return None
+
+
+def _find_route(path):
+  found = _match_route(_ROUTES, [s for s in path.split('/') if s], 0, [])
+  return found or (None, None)
+
+
+# Decorator for registering functions as URL handlers. Paths may contain
+# <param> segments, or end in /* to match everything below a prefix.
 def url(*paths, **attrs):
   def decorate(func):
     for path in paths:
-      _HANDLERS[path] = (func, attrs)
+      if '<' in path or path.endswith('*'):
+        _add_route(path, (func, attrs))
+      else:
+        _HANDLERS[path.rstrip('/') or '/'] = (func, attrs)
     return func
   return decorate
 
@@ -78,23 +160,137 @@ def buffer_byte_chunks(buf, chunksize):
 
 
 # Helper to read file descriptor right up until the end
-def _read_fd_iterator(fd, readsize, first_item=None):
+def _read_fd_iterator(fd, readsize, first_item=None, nbytes=None):
   if first_item is not None:
     yield first_item
-  while True:
-    data = fd.read(readsize)
+  while (nbytes is None) or (nbytes > 0):
+    data = fd.read(readsize if (nbytes is None) else min(readsize, nbytes))
     if data:
+      if nbytes is not None:
+        nbytes -= len(data)
       yield data
     else:
       break
 
 
+# Helper to fetch the next item from a sync or async iterator
+_EOF = object()
+async def _anext(iterator):
+  try:
+    if hasattr(iterator, '__anext__'):
+      return await iterator.__anext__()
+    return next(iterator)
+  except (StopIteration, StopAsyncIteration):
+    return _EOF
+
+
+# Check whether an Accept-Encoding header allows a given coding; codings
+# are allowed if listed (or matched by *) without a q-value of zero.
+def _accepts_encoding(accept, coding):
+  star = None
+  for part in accept.lower().split(','):
+    part = part.split(';')
+    name, q = part[0].strip(), 1
+    for param in part[1:]:
+      param = param.strip()
+      if param.startswith('q='):
+        try:
+          q = float(param[2:])
+        except ValueError:
+          q = 0
+    if name == coding:
+      return (q > 0)
+    if name == '*':
+      star = (q > 0)
+  return bool(star)
+
+
 def _items(obj):
   if hasattr(obj, 'items'):
     return obj.items()
   return obj
 
 
+# A simple LRU cache with a budget; each entry has a cost, which is its
+# size in bytes or 1 to just limit the number of entries. Entries are
+# kept in order of use, so the least recently used one is always first.
+class LRUCache:
+  def __init__(self, budget):
+    self.budget = budget
+    self.entries = OrderedDict()
+    self.cost = 0
+
+  def get(self, key):
+    item = self.entries.pop(key, None)
+    if item is None:
+      return None
+    self.entries[key] = item
+    return item[1]
+
+  def add(self, key, value, cost=1):
+    if cost > self.budget:
+      return None
+    self.remove(key)
+    while self.entries and (self.cost + cost > self.budget):
+      self.remove(next(iter(self.entries)))
+    self.entries[key] = (cost, value)
+    self.cost += cost
+    return value
+
+  def remove(self, key):
+    item = self.entries.pop(key, None)
+    if item is not None:
+      self.cost -= item[0]
+
+  def clear(self):
+    self.entries = OrderedDict()
+    self.cost = 0
+
+
+# A byte-budgeted LRU cache of small static files, along with their
+# pre-rendered response headers. Entries are revalidated against the
+# file's mtime at most once every STATIC_CACHE_CHECK_MS.
+class StaticCache(LRUCache):
+  class Entry:
+    __slots__ = ('checked', 'filename', 'mtime', 'compress', 'etag',
+                 'last_mod', 'vary', 'head', 'head_ka', 'body', 'nbytes')
+
+    def __init__(self, filename, ftime, compress, etag, last_mod, vary,
+                 head, head_ka, body):
+      self.checked = ticks_ms()
+      self.filename = filename
+      self.mtime = ftime
+      self.compress = compress
+      self.etag = etag
+      self.last_mod = last_mod
+      self.vary = vary
+      self.head = head
+      self.head_ka = head_ka
+      self.body = body
+      self.nbytes = len(head) + len(head_ka) + len(body)
+
+  def __init__(self, uPK):
+    LRUCache.__init__(self, uPK.STATIC_CACHE_BYTES)
+    self.uPK = uPK
+
+  def get(self, key):
+    entry = LRUCache.get(self, key)
+    if entry is not None:
+      now = ticks_ms()
+      if ticks_diff(now, entry.checked) > self.uPK.STATIC_CACHE_CHECK_MS:
+        try:
+          if mtime(entry.filename) != entry.mtime:
+            raise OSError()
+          entry.checked = now
+        except OSError:
+          self.remove(key)
+          return None
+    return entry
+
+  def add(self, key, entry):
+    return LRUCache.add(self, key, entry, entry.nbytes)
+
+
 # Helper class for navigating the request environment
 class ReqEnv:
   def __init__(self, env):
@@ -124,11 +320,13 @@ class ReqEnv:
   query_vars = property(lambda s: dict(_items(s['http_headers']['_qs'])))
   query_tuples = property(lambda s: s['http_headers']['_qs'])
   request_path = property(lambda s: s['http_headers']['_path'])
+  path_params = property(lambda s: s['http_headers'].get('_params', {}))
   http_method = property(lambda s: s['http_headers']['_method'])
   http_headers = property(lambda s: s['http_headers'])
   http_host = property(lambda s: s['frame'].host)
   http_port = property(lambda s: s['frame'].port)
   payload = property(lambda s: s['frame'].payload)
+  request_body = property(lambda s: s.get('request_body'))
   frame = property(lambda s: s['frame'])
 
 
@@ -137,12 +335,20 @@ class HTTPD:
     'GET',
     'HEAD',
     'POST')
+  PREFIX_CACHE_MAX = 16
 
   def __init__(self, name, webroot, env, uPK):
     self.uPK = uPK
     self.name = name
     self.webroot = webroot
     self.static_max_age = 3600
+    self._render_default_headers()
+    self.static_cache = StaticCache(uPK) if uPK.STATIC_CACHE_BYTES else None
+    self.path_cache = (
+      LRUCache(uPK.PATH_CACHE_ENTRIES) if uPK.PATH_CACHE_ENTRIES else None)
+    self.code_cache = (
+      LRUCache(uPK.CODE_CACHE_ENTRIES)
+      if (uPK.CODE_CACHE_ENTRIES and HAVE_COMPILE) else None)
     self.base_env = env
 
   @classmethod
@@ -172,32 +378,52 @@ class HTTPD:
       [cls.unquote(part) for part in pair.split('=', 1)]
       for pair in qs.split('&')]
 
-  def http_response(self, code, msg, mimetype, ttl=None, hdrs={}):
-    for hdr, default in (
-            ('Access-Control-Allow-Origin', self.uPK.HTTP_CORS_ORIGIN),
-            ('Access-Control-Allow-Methods', self.uPK.HTTP_CORS_METHODS),
-            ('Access-Control-Allow-Headers', self.uPK.HTTP_CORS_HEADERS),
-            ('Content-Security-Policy', self.uPK.HTTP_CONTENT_SECURITY_POLICY),
-            ('Referrer-Policy', self.uPK.HTTP_REFERRER_POLICY)):
-        if default:
-            if hdr not in hdrs:
-                hdrs[hdr] = default
+  def _render_default_headers(self):
+    # The security headers rarely vary, so we render them just once.
+    self.default_hdrs = [
+      (hdr, '%s: %s\r\n' % (hdr, default)) for hdr, default in (
+        ('Access-Control-Allow-Origin', self.uPK.HTTP_CORS_ORIGIN),
+        ('Access-Control-Allow-Methods', self.uPK.HTTP_CORS_METHODS),
+        ('Access-Control-Allow-Headers', self.uPK.HTTP_CORS_HEADERS),
+        ('Content-Security-Policy', self.uPK.HTTP_CONTENT_SECURITY_POLICY),
+        ('Referrer-Policy', self.uPK.HTTP_REFERRER_POLICY))
+      if default]
+    self.default_hdrs_str = ''.join(line for hdr, line in self.default_hdrs)
+    self.response_prefixes = {}
+
+  def http_response(self, code, msg, mimetype, ttl=None, hdrs=None):
+    hdrs = hdrs or {}
     try:
-        code = int(code)
+      code = int(code)
     except ValueError as e:
-        if self.uPK.error:
-            self.uPK.error('[www] Invalid return code %s: %s' % (code, e))
-        code = 500
-    return (
-        'HTTP/%s %d %s\r\n'
-        'Server: %s\r\n'
-        '%s%s%s\r\n'
-      ) % (
-        '1.1' if ('Upgrade' in hdrs) else '1.0',
-        code, msg, self.uPK.APPURL,
-        ('Content-Type: %s\r\n' % mimetype) if mimetype else '',
-        ('Cache-Control: max-age=%d, private\r\n' % ttl) if ttl else '',
-        ''.join('%s: %s\r\n' % (k, v) for k, v in hdrs.items()))
+      if self.uPK.error:
+        self.uPK.error('[www] Invalid return code %s: %s' % (code, e))
+      code = 500
+
+    # Status, Server and Content-Type lines are cached for common replies
+    version = '1.1' if ('Upgrade' in hdrs or 'Connection' in hdrs) else '1.0'
+    key = (version, code, msg, mimetype)
+    prefix = self.response_prefixes.get(key)
+    if prefix is None:
+      if len(self.response_prefixes) >= self.PREFIX_CACHE_MAX:
+        self.response_prefixes = {}
+      prefix = self.response_prefixes[key] = (
+        'HTTP/%s %d %s\r\nServer: %s\r\n%s' % (
+          version, code, msg, self.uPK.APPURL,
+          ('Content-Type: %s\r\n' % mimetype) if mimetype else ''))
+
+    defaults = self.default_hdrs_str
+    for hdr, line in self.default_hdrs:
+      if hdr in hdrs:
+        defaults = ''.join(l for h, l in self.default_hdrs if h not in hdrs)
+        break
+
+    return ''.join((
+      prefix,
+      ('Cache-Control: max-age=%d, private\r\n' % ttl) if ttl else '',
+      ''.join('%s: %s\r\n' % (k, v) for k, v in hdrs.items()),
+      defaults,
+      '\r\n'))
 
   def log_request(self, frame, method, path, code,
                   sent='-', headers={}, user='-'):
@@ -208,32 +434,178 @@ class HTTPD:
         code, sent,
         headers.get('User-Agent', headers.get('user-agent', '-'))))
 
-  async def _err(self, code, msg, method, path, conn, frame, headers={}):
+  async def _err(self, code, msg, method, path, conn, frame, headers={},
+                 hdrs=None):
     self.log_request(frame, method, path, code, headers=headers)
-    hdrs = {'WWW-Authenticate': 'Basic'} if (code == 401) else {}
+    if hdrs is None:
+      hdrs = {'WWW-Authenticate': 'Basic'} if (code == 401) else {}
     await conn.reply(frame,
       self.http_response(code, msg, 'text/plain', hdrs=hdrs)+msg+'\n')
 
+  def invalidate_caches(self):
+    """
+    Forget cached paths and files; apps which add or remove files in the
+    webroot should call this. Changes to existing files are noticed.
+    """
+    for cache in (self.path_cache, self.static_cache, self.code_cache):
+      if cache is not None:
+        cache.clear()
+
+  def resolve_path(self, filename):
+    # Returns (filename, has_gz), where filename is None if not found.
+    try:
+      ls = [l[0] for l in ilistdir(filename)]
+      if 'index.py' in ls:
+        filename = filename + '/index.py'
+      elif 'index.html' in ls:
+        filename = filename + '/index.html'
+      del ls
+    except:
+      pass
+    try:
+      if stat(filename)[0] & 0x4000:  # S_IFDIR
+        raise OSError()
+    except OSError:
+      filename = self.webroot + '/404.py'
+      try:
+        stat(filename)
+      except OSError:
+        return (None, False)
+    if filename.endswith('.py'):
+      return (filename, False)
+    try:
+      stat(filename + '.gz')
+      return (filename, True)
+    except OSError:
+      return (filename, False)
+
+  def compiled(self, filename, fd):
+    # Returns compiled code for a .py page, reusing it until the file
+    # changes. Without compile(), we just return the source.
+    if self.code_cache is None:
+      return str(fd.read(), 'utf-8')
+    ftime = mtime(filename)
+    cached = self.code_cache.get(filename)
+    if (cached is None) or (cached[0] != ftime):
+      code = compile(str(fd.read(), 'utf-8'), filename, 'exec')
+      cached = self.code_cache.add(filename, (ftime, code)) or (ftime, code)
+    return cached[1]
+
+  def static_validators(self, ftime, filesize):
+    return {
+      'ETag': '"%x-%x"' % (ftime, filesize),
+      'Last-Modified': http_date(ftime)}
+
+  def not_modified(self, headers, etag, last_mod):
+    # Note: Clients echo back our Last-Modified verbatim, so we compare
+    #       strings instead of parsing dates, which is costly on the ESP32.
+    inm = headers.get('If-None-Match')
+    if inm is not None:
+      return (inm.strip() == '*') or (etag in inm)
+    return (headers.get('If-Modified-Since') == last_mod)
+
+  async def send_not_modified(self, etag, method, path, keep_alive,
+                              conn, frame, headers, vary=False):
+    # A 304 must carry the same Vary as the 200 it stands in for.
+    hdrs = {'ETag': etag}
+    if vary:
+      hdrs['Vary'] = 'Accept-Encoding'
+    if keep_alive and conn.keep_alive(frame):
+      hdrs['Connection'] = 'keep-alive'
+    data = self.http_response(
+      304, 'Not Modified', None, self.static_max_age, hdrs)
+    await conn.reply(frame, data, eof=True)
+    self.log_request(frame, method, path, 304, len(data), headers)
+
+  def byte_range(self, headers, filesize, validators):
+    # Returns (first, last) for a satisfiable single byte range, False if
+    # it cannot be satisfied, or None if the whole file should be sent.
+    # Invalid ranges are ignored (RFC 9110, section 14.2).
+    rng = headers.get('Range', '')
+    if (not rng.startswith('bytes=')) or (',' in rng):
+      return None
+    if_range = headers.get('If-Range')
+    if if_range and (if_range not in validators.values()):
+      return None
+    try:
+      first, last = rng[6:].split('-', 1)
+      if first:
+        first = int(first)
+        last = int(last) if last else None
+        if (last is not None) and (first > last):
+          return None
+        if first >= filesize:
+          return False
+        if (last is None) or (last >= filesize):
+          last = filesize - 1
+      else:
+        first = max(0, filesize - int(last))
+        last = filesize - 1
+        if first >= filesize:
+          return False
+    except ValueError:
+      return None
+    return (first, last)
+
+  def cache_static(self, key, filename, fd, ftime, filesize, mimetype,
+                   encoding=None, vary=False):
+    body = fd.read()
+    if len(body) != filesize:
+      return None
+    ttl = self.static_max_age
+    hdrs = self.static_validators(ftime, filesize)
+    hdrs['Accept-Ranges'] = 'bytes'
+    hdrs['Content-Length'] = filesize
+    if encoding:
+      hdrs['Content-Encoding'] = encoding
+    if vary:
+      hdrs['Vary'] = 'Accept-Encoding'
+    head = bytes(self.http_response(200, 'OK', mimetype, ttl, hdrs), 'latin-1')
+    hdrs['Connection'] = 'keep-alive'
+    head_ka = bytes(
+      self.http_response(200, 'OK', mimetype, ttl, hdrs), 'latin-1')
+    return self.static_cache.add(key, StaticCache.Entry(
+      filename, ftime,
+      (not encoding) and self.uPK.compressible(mimetype),
+      hdrs['ETag'], hdrs['Last-Modified'], vary,
+      head, head_ka, body))
+
+  async def send_cached(self, entry, method, path, keep_alive, conn, frame,
+                        headers):
+    if self.not_modified(headers, entry.etag, entry.last_mod):
+      return await self.send_not_modified(
+        entry.etag, method, path, keep_alive, conn, frame, headers,
+        vary=entry.vary)
+    if keep_alive and conn.keep_alive(frame):
+      data = entry.head_ka
+    else:
+      data = entry.head
+    if method != 'HEAD':
+      data += entry.body
+    conn.set_compression(frame.sid, entry.compress)
+    await conn.reply(frame, data, eof=True)
+    self.log_request(frame, method, path, 200, len(data), headers)
+
   async def background_send(self,
         iterator, first_reply, conn, frame, method, path, hdrs, _close=[]):
     # Abort the upload if the remote end closes the connection
     saw_eof = [False]
-    progress = [0]
-    def beware_eof(frm):
+    async def beware_eof(frm):
       saw_eof[0] = saw_eof[0] or ('W' in frm.eof)
-      if 'SKB' in frm.headers:
-        progress[0] = int(frm.headers['SKB'])
 
     # Iteratively send our data
     async def async_send_data():
       sent = 0
       code = 200
       want_eof = True
-      sent_first = False
+      chunked = sent_first = False
       try:
         await fuzzy_sleep_ms(10)
 
-        first_item = next(iterator)
+        first_item = await _anext(iterator)
+        if first_item is _EOF:
+          raise ValueError('Empty response')
+        code = first_item.get('code', code)
         if method == 'HEAD':
           first_item['eof'] = True
           first_item['suppress_log'] = False
@@ -244,6 +616,16 @@ class HTTPD:
 
         want_eof = first_item.get('eof', want_eof)
         first_item['eof'] = False
+        chunked = want_eof and self.use_chunked(first_item, hdrs)
+        if chunked:
+          first_item['hdrs'] = dict(first_item.get('hdrs') or {})
+          first_item['hdrs']['Transfer-Encoding'] = 'chunked'
+          # An empty chunk would end the stream, so only frame real data.
+          body = first_item.pop('body', None)
+          if body:
+            if isinstance(body, str):
+              body = bytes(body, 'utf-8')
+            first_item['body'] = b'%x\r\n%s\r\n' % (len(body), body)
         sent = first_reply(**first_item)
         sent_first = True
 
@@ -251,22 +633,27 @@ class HTTPD:
         #       not give control back to the main event loop which reads
         # the PageKite tunnel, the "ack" packets may build up and cause
         # our ESP32 devices to run out of RAM and break the connection.
-        conn.await_data(self.uPK, frame.sid, beware_eof)
-        for app_data in iterator:
+        # Flow control (avoiding buffer bloat) happens in conn.reply().
+        conn.async_await_data(self.uPK, frame.sid, beware_eof)
+        while True:
+          app_data = await _anext(iterator)
+          if app_data is _EOF:
+            break
           for data in buffer_byte_chunks(app_data, self.uPK.SEND_WINDOW_BYTES):
             await fuzzy_sleep_ms(5)
             if saw_eof[0]:
               break
 
+            if chunked:
+              data = b'%x\r\n%s\r\n' % (len(data), data)
             await conn.reply(frame, data, eof=False)
             sent += len(data)
-            # Avoid buffer bloat
-            while (progress[0]
-                  and not saw_eof[0]
-                  and (progress[0] * 1024) < (sent - self.uPK.SEND_WINDOW_BYTES)):
-              await fuzzy_sleep_ms(50)
           if saw_eof[0]:
             break
+        if chunked and not saw_eof[0]:
+          await conn.reply(frame, b'0\r\n\r\n', eof=want_eof)
+          sent += 5
+          want_eof = False
 
       except Exception as e:
         code = '-'
@@ -281,7 +668,14 @@ class HTTPD:
           self.log_request(frame, method, path, code, sent, hdrs)
         for fd in _close:
           fd.close()
-        if frame.sid in conn.handlers:
+        if hasattr(iterator, 'aclose'):
+          try:
+            await iterator.aclose()
+          except:
+            pass
+        # A keep-alive EOF may already have dispatched the next request
+        # on this SID; only remove our own handler, never its.
+        if conn.handlers.get(frame.sid) is beware_eof:
           del conn.handlers[frame.sid]
         if want_eof:
           try:
@@ -292,12 +686,22 @@ class HTTPD:
     asyncio.get_event_loop().create_task(async_send_data())
     await fuzzy_sleep_ms(1)
 
+  def use_chunked(self, first_item, req_hdrs):
+    # Chunked encoding lets us stream responses of unknown length, over
+    # connections which stay open, but requires an HTTP/1.1 client.
+    hdrs = first_item.get('hdrs') or {}
+    return (
+      req_hdrs.get('_http') == 'HTTP/1.1' and
+      first_item.get('code', 200) not in (204, 304) and
+      'Content-Length' not in hdrs and
+      'Transfer-Encoding' not in hdrs and
+      'Upgrade' not in hdrs)
+
   async def run_handler(self, func, func_attrs, req_env):
     req_env['url_func_attrs'] = func_attrs
-    if func_attrs.get('_async'):
-      result = await func(req_env)
-    else:
-      result = func(req_env)
+    result = func(req_env)
+    if func_attrs.get('_async') and not hasattr(result, '__anext__'):
+      result = await result
 
     if result is not None:
       if isinstance(result, dict):
@@ -313,10 +717,15 @@ class HTTPD:
           req_env['http_headers'])
 
   def get_handler(self, path, headers):
-    return _HANDLERS.get(path, (None, None))
+    handler = _HANDLERS.get(path.rstrip('/') or '/')
+    if handler is None and _ROUTES:
+      handler, params = _find_route(path)
+      if handler is not None:
+        headers['_params'] = params
+    return handler or (None, None)
 
   async def handle_http_request(self, kite, conn, frame):
-    method = path = '-'
+    method = path = pathqs = '-'
     self.uPK.GC_COLLECT()
     try:
       headers = frame.payload.split(b'\r\n\r\n', 1)[0]
@@ -339,6 +748,14 @@ class HTTPD:
         if self.uPK.PARSE_HTTP_HEADERS.match(l)]
       headers = dict(headers)
 
+      # Should we keep the connection open after replying?
+      headers['_http'] = http = http.strip()
+      conn_hdr = headers.get('Connection', '').lower()
+      if http == 'HTTP/1.1':
+        keep_alive = ('close' not in conn_hdr)
+      else:
+        keep_alive = ('keep-alive' in conn_hdr)
+
     except Exception as e:
       return await self._err(400, 'Invalid request', method, pathqs, conn, frame)
 
@@ -351,24 +768,51 @@ class HTTPD:
 
     await fuzzy_sleep_ms()
     if func is None:
-      try:
-        ls = [l[0] for l in ilistdir(filename)]
-        if 'index.py' in ls:
-          filename = filename + '/index.py'
-        elif 'index.html' in ls:
-          filename = filename + '/index.html'
-        del ls
-      except:
-        pass
+      cache_key = filename
+      resolved = self.path_cache and self.path_cache.get(cache_key)
+      if not resolved:
+        resolved = self.resolve_path(filename)
+        if self.path_cache:
+          self.path_cache.add(cache_key, resolved)
+      filename, has_gz = resolved
+      if filename is None:
+        return await self._err(
+          404, 'Not Found', method, pathqs, conn, frame, headers)
+
+      # Serve precompressed variants (see scripts/gzip_static.py)
+      gzip = (has_gz and method != 'POST'
+        and _accepts_encoding(headers.get('Accept-Encoding', ''), 'gzip'))
+      if gzip:
+        cache_key = 'gzip:' + cache_key
+      if self.static_cache and method != 'POST' and 'Range' not in headers:
+        entry = self.static_cache.get(cache_key)
+        if entry is not None:
+          return await self.send_cached(
+            entry, method, pathqs, keep_alive, conn, frame, headers)
+
+      encoding = validators = None
+      mimetype = filename_to_mimetype(filename)
+      if gzip:
+        filename += '.gz'
+        encoding = 'gzip'
+      if method != 'POST' and not filename.endswith('.py'):
+        try:
+          st = stat(filename)
+          validators = self.static_validators(st[8], st[6])
+          if self.not_modified(headers,
+                               validators['ETag'], validators['Last-Modified']):
+            return await self.send_not_modified(validators['ETag'],
+              method, pathqs, keep_alive, conn, frame, headers,
+              vary=has_gz)
+        except OSError:
+          pass
       try:
         fd = open(filename, 'rb')
       except:
-        try:
-          filename = self.webroot + '/404.py'
-          fd = open(filename, 'rb')
-        except:
-          return await self._err(
-            404, 'Not Found', method, pathqs, conn, frame, headers)
+        if self.path_cache:
+          self.path_cache.remove(self.webroot + path)
+        return await self._err(
+          404, 'Not Found', method, pathqs, conn, frame, headers)
     else:
       fd = None
 
@@ -379,11 +823,24 @@ class HTTPD:
             body='', mimetype='text/html; charset=utf-8',
             code=200, msg='OK', ttl=None, eof=True, hdrs={},
             suppress_log=False):
-        rdata = bytes(
-          self.http_response(code, msg, mimetype, ttl, hdrs), 'utf-8')
+        hdrs = dict(hdrs)
         if body and method != 'HEAD':
-          rdata += (
-            bytes(body, 'utf-8') if isinstance(body, str) else bytes(body))
+          body = bytes(body, 'utf-8') if isinstance(body, str) else bytes(body)
+        else:
+          body = b''
+        if (eof and method != 'HEAD' and code not in (204, 304)
+            and 'Content-Length' not in hdrs):
+          hdrs['Content-Length'] = len(body)
+        if (keep_alive
+            and ('Content-Length' in hdrs or 'Transfer-Encoding' in hdrs)
+            and 'Upgrade' not in hdrs and conn.keep_alive(frame)):
+          hdrs['Connection'] = 'keep-alive'
+        elif 'Transfer-Encoding' in hdrs:
+          hdrs['Connection'] = 'close'  # Chunking implies HTTP/1.1
+        rdata = bytes(
+          self.http_response(code, msg, mimetype, ttl, hdrs), 'utf-8') + body
+        conn.set_compression(frame.sid,
+          ('Content-Encoding' not in hdrs) and self.uPK.compressible(mimetype))
         conn.sync_reply(frame, rdata, eof=eof)
         if not suppress_log:
           sent = len(rdata) if eof else '-'
@@ -410,21 +867,51 @@ class HTTPD:
         req_env['req_env'] = ReqEnv(req_env)
         if fd:
           await fuzzy_sleep_ms(25)
-          code = str(fd.read(), 'utf-8')
+          code = self.compiled(filename, fd)
           self.uPK.GC_COLLECT()
           exec(code, req_env)
         else:
           await fuzzy_sleep_ms()
           await self.run_handler(func, func_attrs, req_env['req_env'])
       else:
-        filesize = size(filename)
+        st = stat(filename)
+        filesize = st[6]
+        hdrs = dict(validators or {})
+        hdrs['Accept-Ranges'] = 'bytes'
+        rng = (method != 'POST') and self.byte_range(headers, filesize, validators or {})
+        if rng is False:
+          return await self._err(416, 'Range Not Satisfiable',
+            method, pathqs, conn, frame, headers,
+            hdrs={'Content-Range': 'bytes */%d' % filesize})
+        if (self.static_cache and method != 'POST' and not rng
+            and filesize <= self.uPK.STATIC_CACHE_MAX_FILE):
+          entry = self.cache_static(
+            cache_key, filename, fd, st[8], filesize, mimetype, encoding,
+            vary=has_gz)
+          if entry is not None:
+            return await self.send_cached(
+              entry, method, pathqs, keep_alive, conn, frame, headers)
+          fd.seek(0)
+        code, msg, nbytes = 200, 'OK', filesize
+        if rng:
+          code, msg, nbytes = 206, 'Partial Content', rng[1] - rng[0] + 1
+          hdrs['Content-Range'] = 'bytes %d-%d/%d' % (rng[0], rng[1], filesize)
+          fd.seek(rng[0])
+        hdrs['Content-Length'] = nbytes
+        if encoding:
+          hdrs['Content-Encoding'] = encoding
+        if has_gz:
+          hdrs['Vary'] = 'Accept-Encoding'
         await self.background_send(
           _read_fd_iterator(fd, self.uPK.FILE_READ_BYTES,
             first_item={
-              'hdrs': {'Content-Length': filesize},
-              'suppress_log': (filesize < 102400),
-              'mimetype': filename_to_mimetype(filename),
-              'ttl': self.static_max_age}),
+              'code': code,
+              'msg': msg,
+              'hdrs': hdrs,
+              'suppress_log': (nbytes < 102400),
+              'mimetype': mimetype,
+              'ttl': self.static_max_age},
+            nbytes=nbytes),
           first_reply, conn, frame, method, pathqs, headers, _close=[fd])
         fd = None
     except PermissionError as e:
@@ -33,10 +33,6 @@ UPAGEKITE_VERSION = '0.3.2'
 # This is a cache of DNS hints we have recived from the network.
 _DNS_HINTS = {}
 
-# A global counter for bytes we've sent over the network
-SENT_COUNTER = 0
-SENT_DELAYS = 0
-
 # Prefixes to search when trying to open() files from within the webapp.
 APP_ROOT_PREFIXES = ('/bootstrap_live', '/bootstrap', '')
 
@@ -73,10 +69,14 @@ except ImportError:
       return _print_exc()
 
 try:
-  from time import ticks_ms
+  from time import ticks_ms, ticks_add, ticks_diff
 except ImportError:
   def ticks_ms():
     return int(time.time() * 1000)
+  def ticks_add(ticks, delta):
+    return ticks + delta
+  def ticks_diff(ticks1, ticks2):
+    return ticks1 - ticks2
 
 try:
   from os import urandom as random_bytes
@@ -108,6 +108,39 @@ except ImportError:
     except ImportError:
         ssl = False
 
+try:
+  import zlib
+  if not (hasattr(zlib, 'compressobj') and hasattr(zlib, 'decompressobj')):
+    zlib = False
+except ImportError:
+  zlib = False
+
+try:
+  from errno import EAGAIN
+except ImportError:
+  EAGAIN = 11
+
+# Errors which just mean a non-blocking write should be retried later.
+SSL_WANT_ERRORS = tuple(getattr(ssl, e)
+  for e in ('SSLWantReadError', 'SSLWantWriteError') if hasattr(ssl, e))
+
+def _would_block(e):
+  return (
+    (e.args and e.args[0] == EAGAIN) or
+    (SSL_WANT_ERRORS and isinstance(e, SSL_WANT_ERRORS)))
+
+# TLS sockets claim to have sendmsg(), but do not implement it.
+SSL_SOCKET = getattr(ssl, 'SSLSocket', None)
+
+# Limit on how many buffers we pass to a single sendmsg() call.
+MAX_IOVEC = 64
+
+
+def buffers_len(data):
+  if isinstance(data, list):
+    return sum(len(d) for d in data)
+  return len(data)
+
 try:
     from utime import sleep_ms as real_sleep_ms
     from uasyncio import sleep_ms
@@ -179,6 +212,13 @@ class EofStream(IOError):
   pass
 
 
+try:
+  current_task = asyncio.current_task
+except AttributeError:
+  def current_task():
+    return None
+
+
 if IS_MICROPYTHON:
   async def fuzzy_sleep_ms(ms=0):
     real_sleep_ms(1)
@@ -204,35 +244,434 @@ class Kite:
     self.secret = secret
     self.challenge = ''
     self.handler = handler
+    self.limiter = None
 
   def __str__(self):
     return '%s://%s' % (self.pproto, self.name)
 
 
+class TokenBucket:
+  """
+  A token bucket rate limiter: up to `burst` bytes may be sent at once,
+  after which traffic is throttled to `rate` bytes per second.
+  """
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.ts = ticks_ms()
+
+  def take(self, nbytes):
+    """
+    Spend tokens for nbytes of traffic, returning how many milliseconds
+    the caller should sleep to stay within the rate limit.
+    """
+    now = ticks_ms()
+    elapsed = max(0, ticks_diff(now, self.ts))  # ticks_ms() wraps
+    self.tokens = min(self.burst, self.tokens + elapsed * self.rate / 1000)
+    self.ts = now
+    self.tokens -= nbytes
+    if self.tokens >= 0:
+      return 0
+    return 1 + int(-self.tokens * 1000 / self.rate)
+
+
+def _scan_header(hdr, name):
+  # Find a header value in raw bytes, without parsing everything. The
+  # header block must end with a CRLF. Returns None if not found.
+  if hdr.startswith(name):
+    beg = len(name)
+  else:
+    beg = hdr.find(b'\n' + name)
+    if beg < 0:
+      return None
+    beg += len(name) + 1
+  return str(hdr[beg:hdr.find(b'\r\n', beg)], 'latin-1').strip()
+
+
 class Frame:
+  """
+  A single tunnel frame. Only the headers needed to dispatch the frame
+  (SID, EOF, SKB, PING, NOOP) are scanned for up front, the full header
+  dict is only built if someone asks for it.
+  """
+  __slots__ = (
+    'uPK', 'cid', 'payload', 'sid', 'eof', 'skb', 'ping', 'noop',
+    '_hdr', '_headers', '_uid')
+
   def __init__(self, uPK, data=None, headers=None, payload=None, cid=''):
     self.uPK = uPK
     self.cid = '%s' % (cid,)
+    self._uid = None
     if data:
-      hdr_len = data.index(b'\r\n\r\n')
-      hdr = str(data[:hdr_len], 'latin-1')
-      self.payload = data[hdr_len+4:]
-      self.headers = dict(ln.strip().split(': ', 1)
-        for ln in hdr.splitlines())
+      # Data may be a memoryview into a TunnelStream buffer, so we copy out
+      # exactly what we need and keep no references to the original.
+      hdr = bytes(data[:512])
+      hdr_len = hdr.find(b'\r\n\r\n')
+      if hdr_len < 0:
+        hdr = bytes(data)
+        hdr_len = hdr.index(b'\r\n\r\n')
+      self._hdr = hdr = hdr[:hdr_len+2]
+      self._headers = None
+      self.payload = bytes(data[hdr_len+4:])
+      self.sid = _scan_header(hdr, b'SID: ')
+      self.eof = _scan_header(hdr, b'EOF: ') or ''
+      self.skb = _scan_header(hdr, b'SKB: ')
+      self.ping = _scan_header(hdr, b'PING: ')
+      self.noop = _scan_header(hdr, b'NOOP: ')
     else:
-      self.headers = headers
+      self._hdr = None
+      self._headers = headers
       self.payload = payload
-
-  eof = property(lambda s: s.headers.get('EOF', ''))
-  skb = property(lambda s: s.headers.get('SKB'))
-  sid = property(lambda s: s.headers.get('SID'))
-  uid = property(lambda s: s.cid + s.headers.get('SID'))
+      self.sid = headers.get('SID')
+      self.eof = headers.get('EOF', '')
+      self.skb = headers.get('SKB')
+      self.ping = headers.get('PING')
+      self.noop = headers.get('NOOP')
+
+  def _get_headers(self):
+    if self._headers is None:
+      self._headers = dict(ln.strip().split(': ', 1)
+        for ln in str(self._hdr, 'latin-1').splitlines())
+      self._hdr = None
+    return self._headers
+
+  def _get_uid(self):
+    if self._uid is None:
+      self._uid = self.cid + self.sid
+    return self._uid
+
+  headers = property(_get_headers)
+  uid = property(_get_uid)
   tls = property(lambda s: s.headers.get('RTLS'))
   host = property(lambda s: s.headers.get('Host'))
   port = property(lambda s: s.headers.get('Port'))
   proto = property(lambda s: s.headers.get('Proto'))
   remote_ip = property(lambda s: s.headers.get('RIP'))
-  ping = property(lambda s: s.headers.get('PING'))
+
+
+class TunnelStream:
+  """
+  A buffered wrapper around a relay connection. Reads go through one
+  reusable receive buffer, so many chunks can be parsed per socket read
+  and payloads are handed out as memoryview slices of that buffer.
+
+  Note: slices returned by read_chunk() are only valid until the next read.
+
+  Writes are queued and drained without blocking, whenever the socket is
+  writable; see queue_write() and flush_writes(). Queued buffers are sent
+  using sendmsg() where available, otherwise small ones are coalesced, so
+  a burst of frames costs a single socket write either way.
+
+  Once ZChunks have been negotiated (see enable_zchunks()), compressed
+  chunks are inflated transparently by read_chunk(), and queue_zchunk()
+  can be used to send compressed data.
+  """
+  MAX_CHUNK_HEADER = 24
+
+  def __init__(self, uPK, fd, conn):
+    self.uPK = uPK
+    self.fd = fd
+    self.conn = conn
+    self.rpos = self.rend = 0
+    self.wqueue = []
+    self.wbytes = 0
+    self.wretry = False
+    self.sendmsg = None
+    if not (SSL_SOCKET and isinstance(fd, SSL_SOCKET)):
+      self.sendmsg = getattr(fd, 'sendmsg', None)
+    self.limiter = uPK.make_rate_limiter(uPK.TUNNEL_BYTES_PER_SEC)
+    self.deflate = self.inflate = None
+    self.zreset = False
+    self._reset_rbuf()
+
+  buffered = property(lambda s: s.rend - s.rpos)
+
+  def __str__(self):
+    return '<TunnelStream(%s)>' % (self.conn,)
+
+  def _reset_rbuf(self, size=0):
+    self.rbuf = bytearray(max(size, self.uPK.TUNNEL_READ_BYTES))
+    self.rmv = memoryview(self.rbuf)
+
+  def write(self, data):
+    return self.conn.write(data)
+
+  def flush(self):
+    if hasattr(self.conn, 'flush'):
+      self.conn.flush()
+
+  def close(self):
+    self.wqueue = []
+    self.wbytes = 0
+    self.wretry = False
+    self.conn.close()
+
+  def wants_write(self):
+    return bool(self.wqueue)
+
+  def queue_write(self, data):
+    """
+    Queue a buffer, or a list of buffers, for writing. Buffers are kept
+    by reference until written, so they must not be modified.
+    """
+    if isinstance(data, list):
+      for d in data:
+        self.queue_write(d)
+    elif data:
+      self.wqueue.append(data)
+      self.wbytes += len(data)
+
+  def _write_nb(self, func, data):
+    try:
+      return func(data)
+    except OSError as e:
+      if not _would_block(e):
+        raise
+      return None
+
+  def _gather(self):
+    limit = self.uPK.SEND_WINDOW_BYTES
+    count = size = 0
+    for data in self.wqueue:
+      if count and ((size + len(data) > limit) or (count >= MAX_IOVEC)):
+        break
+      size += len(data)
+      count += 1
+    return self.wqueue[:count]
+
+  def _advance(self, sent):
+    self.wbytes -= sent
+    while sent:
+      data = self.wqueue[0]
+      if sent < len(data):
+        self.wqueue[0] = memoryview(data)[sent:]
+        return
+      sent -= len(data)
+      self.wqueue.pop(0)
+
+  def _coalesce(self):
+    # Merge small writes at the head of the queue, up to one send window.
+    # This must not happen while retrying, as TLS requires retries to
+    # repeat the exact same write.
+    limit = self.uPK.SEND_WINDOW_BYTES
+    if self.wretry or len(self.wqueue) < 2 or len(self.wqueue[0]) >= limit:
+      return
+    buf = bytearray()
+    count = 0
+    for data in self.wqueue:
+      if count and (len(buf) + len(data) > limit):
+        break
+      buf.extend(data)
+      count += 1
+    if count > 1:
+      del self.wqueue[:count]
+      self.wqueue.insert(0, buf)
+
+  def flush_writes(self):
+    """
+    Write as much queued data as the socket will accept without blocking.
+    Returns True if the queue was fully drained.
+    """
+    if not self.wqueue:
+      return True
+    self.fd.setblocking(False)
+    try:
+      while self.wqueue:
+        if self.sendmsg:
+          sent = self._write_nb(self.sendmsg, self._gather())
+        else:
+          self._coalesce()
+          sent = self._write_nb(self.conn.write, self.wqueue[0])
+        self.wretry = not sent
+        if not sent:
+          break
+        self._advance(sent)
+    finally:
+      self.fd.settimeout(self.uPK.SOCKET_TIMEOUTS[1])
+    if not self.wqueue:
+      self.flush()
+      return True
+    return False
+
+  def _fill(self, want):
+    have = self.rend - self.rpos
+    if have >= want:
+      return
+    if self.rpos + want > len(self.rbuf):
+      # Move leftovers to the front, growing the buffer if it is too small.
+      left = bytes(self.rmv[self.rpos:self.rend])
+      if want > len(self.rbuf):
+        self._reset_rbuf(want)
+      self.rmv[:have] = left
+      self.rpos, self.rend = 0, have
+    while self.rend - self.rpos < want:
+      count = self.conn.readinto(self.rmv[self.rend:])
+      if not count:
+        raise EofTunnelError()
+      self.rend += count
+
+  def _consume(self, count):
+    self.rpos += count
+    if self.rpos == self.rend:
+      self.rpos = self.rend = 0
+      if len(self.rbuf) > self.uPK.TUNNEL_READ_BYTES:
+        self._reset_rbuf()
+
+  def _chunk_header(self, fill=True):
+    while True:
+      have = min(self.rend - self.rpos, self.MAX_CHUNK_HEADER)
+      hdr = bytes(self.rmv[self.rpos:self.rpos+have])
+      end = hdr.find(b'\r\n')
+      if end >= 0:
+        # Compressed chunks are "<plain>Z<compressed>", either kind may
+        # carry an R suffix which resets the compression state.
+        size = str(hdr[:end], 'latin-1').strip()
+        if size[-1:] == 'R':
+          size = size[:-1]
+        return hdr[:end+2], int(size.split('Z')[-1], 16)
+      if have >= self.MAX_CHUNK_HEADER:
+        raise ValueError('Invalid chunk header: %s' % hdr)
+      if not fill:
+        return None, 0
+      self._fill(have + 1)
+
+  def ready(self):
+    """
+    Returns True if a complete chunk can be read without waiting for the
+    network. Callers should drain these before polling the socket again.
+    """
+    try:
+      hdr, chunk_len = self._chunk_header(fill=False)
+    except ValueError:
+      return True  # Let read_chunk() report the error
+    if hdr and (self.buffered >= len(hdr) + chunk_len):
+      return True
+    pending = getattr(self.fd, 'pending', None)
+    return bool(pending and pending())
+
+  def read_http_header(self):
+    while True:
+      data = bytes(self.rmv[self.rpos:self.rend])
+      end = data.find(b'\r\n\r\n')
+      if end >= 0:
+        self._consume(end + 4)
+        return data[:end+4]
+      self._fill(len(data) + 1)
+
+  def read_chunk(self):
+    hdr, chunk_len = self._chunk_header()
+    self._fill(len(hdr) + chunk_len)
+    start = self.rpos + len(hdr)
+    payload = self.rmv[start:start+chunk_len]
+    self._consume(len(hdr) + chunk_len)
+    if (b'Z' in hdr) or (b'R' in hdr):
+      payload = self._inflate(hdr, payload)
+    return hdr, payload
+
+  def enable_zchunks(self, level):
+    self.deflate = zlib.compressobj(level)
+    self.inflate = zlib.decompressobj()
+    self.zreset = True
+
+  def _inflate(self, hdr, payload):
+    if b'R' in hdr:
+      if not zlib:
+        raise ValueError('Compressed chunks are not supported')
+      self.inflate = zlib.decompressobj()
+    if b'Z' not in hdr:
+      return payload
+    if self.inflate is None:
+      raise ValueError('Unexpected compressed chunk')
+    plain = self.inflate.decompress(payload)
+    if len(plain) != int(str(hdr.split(b'Z')[0], 'latin-1'), 16):
+      raise ValueError('Invalid compressed chunk: %s' % hdr)
+    return memoryview(plain)
+
+  def queue_zchunk(self, body):
+    """
+    Compress and queue a chunk body, which may be a list of buffers.
+    Chunks must be compressed in the order they are written, so this
+    should only be called when the data is ready to go out.
+    """
+    if not isinstance(body, list):
+      body = [body]
+    zdata = [self.deflate.compress(b) for b in body]
+    zdata.append(self.deflate.flush(zlib.Z_SYNC_FLUSH))
+    zdata = b''.join(zdata)
+    self.queue_write([b'%xZ%x%s\r\n' % (
+        buffers_len(body), len(zdata), b'R' if self.zreset else b''),
+      zdata])
+    self.zreset = False
+
+
+class FrameScheduler:
+  """
+  Decides which queued frame goes out on a tunnel next. Control frames
+  (PING, PONG and EOF) jump the queue, data frames are sent round-robin
+  across streams using deficit round robin, so one big download cannot
+  starve the others.
+
+  Note: An EOF for a stream which still has data queued must wait behind
+  that data, otherwise the stream would be truncated.
+  """
+  def __init__(self, quantum):
+    self.quantum = quantum
+    self.control = []
+    self.queues = {}
+    self.deficits = {}
+    self.active = []
+    self.queued = {}
+
+  pending = property(lambda s: bool(s.control or s.active))
+
+  def queued_for(self, sid):
+    return self.queued.get(sid, 0)
+
+  def add_control(self, data, sid=None):
+    self.control.append((sid, data))
+
+  def add(self, sid, data):
+    # Frames may be a single buffer, or a list of buffers.
+    item = (buffers_len(data), data)
+    if sid in self.queues:
+      self.queues[sid].append(item)
+      self.queued[sid] += item[0]
+    else:
+      self.queues[sid] = [item]
+      self.queued[sid] = item[0]
+      self.deficits[sid] = self.quantum
+      self.active.append(sid)
+
+  def add_eof(self, sid, data):
+    if sid in self.queues:
+      self.add(sid, data)
+    else:
+      self.add_control(data, sid)
+
+  def next(self):
+    """
+    Returns the next frame to send as a (sid, data) tuple, or None.
+    """
+    if self.control:
+      return self.control.pop(0)
+    while self.active:
+      sid = self.active[0]
+      queue = self.queues[sid]
+      if queue[0][0] <= self.deficits[sid]:
+        size, data = queue.pop(0)
+        self.deficits[sid] -= size
+        self.queued[sid] -= size
+        if not queue:
+          self.active.pop(0)
+          del self.queues[sid]
+          del self.deficits[sid]
+          del self.queued[sid]
+        return sid, data
+      # This stream has used up its share, move on to the next one.
+      self.active.append(self.active.pop(0))
+      self.deficits[sid] += self.quantum
+    return None
 
 
 class uPageKiteDefaults:
@@ -242,12 +681,16 @@ class uPageKiteDefaults:
   # Warning: Micropython does not like large regexps, which is why this
   #          one is annoyingly imprecise.
   PARSE_HTTP_HEADERS = re.compile(
-    '^(Auth'
+    '^(Accept-E'
+    '|Auth'
     '|Con[nt]'
     '|Cook'
     '|Host'
+    '|If-'
     '|Orig'
+    '|Range'
     '|Sec-Web'
+    '|Transfer-E'
     '|Upgrade'
     '|User-Agent)[^:]*:')
   FE_NAME = 'fe4_100.b5p.us'  # pagekite.net IPv4 pool for pagekite.py 1.0.0
@@ -269,6 +712,10 @@ class uPageKiteDefaults:
   FE_HINT_NAME = 'fe.b5p.us'
   FE_HINT_URL = ('http', 'pagekite.net', '/logs/relays.txt')
 
+  # On CPython, let the asyncio event loop wake us up when sockets are
+  # ready. Otherwise (or if this is False) we poll, sleeping in between.
+  EVENT_DRIVEN_IO = (not IS_MICROPYTHON)
+
   TICK_INTERVAL = 16
   MIN_CHECK_INTERVAL = 16
   MAX_CHECK_INTERVAL = 900
@@ -284,8 +731,51 @@ class uPageKiteDefaults:
   # larger than FILE_READ_BYTES; so those must be raised together and
   # that will in turn effect RAM usage. This limits performance.
   SEND_WINDOW_BYTES = (1499 if IS_MICROPYTHON else 112909)
+  SEND_QUEUE_BYTES = 2 * SEND_WINDOW_BYTES
+  STREAM_WINDOW_BYTES = 2 * SEND_WINDOW_BYTES
+  SCHEDULER_QUANTUM = 4096
   FILE_READ_BYTES = (1499 if IS_MICROPYTHON else 112909) - 64
-  MS_DELAY_PER_BYTE = (0.025 if IS_MICROPYTHON else 0.005)
+  TUNNEL_READ_BYTES = (2048 if IS_MICROPYTHON else 65536)
+
+  # Handlers which stream request bodies (web.RequestBody) tell the relay
+  # how much they have consumed, once every RECV_ACK_BYTES.
+  RECV_ACK_BYTES = (4096 if IS_MICROPYTHON else 64 * 1024)
+
+  # Rate limits in bytes per second, None disables. The tunnel limit is
+  # per relay connection, the local limit per LocalHTTPKite client socket
+  # and the kite limit is shared by all traffic for each kite. The ESP32
+  # needs throttling to keep from running out of RAM, desktop Pythons do
+  # not. See also TokenBucket and make_rate_limiter().
+  TUNNEL_BYTES_PER_SEC = (40000 if IS_MICROPYTHON else None)
+  LOCAL_BYTES_PER_SEC = (40000 if IS_MICROPYTHON else None)
+  KITE_BYTES_PER_SEC = None
+  RATE_BURST_BYTES = (4096 if IS_MICROPYTHON else 256 * 1024)
+  RATE_LIMITER = TokenBucket
+
+  # Compress tunnel traffic (the ZChunks feature), if the relay agrees.
+  # Only responses with matching MIME-types are compressed, and only
+  # chunks carrying at least COMPRESS_MIN_BYTES of data. This requires
+  # zlib.compressobj(), so is unavailable on MicroPython.
+  TUNNEL_COMPRESSION = (zlib is not False)
+  COMPRESS_LEVEL = 6
+  COMPRESS_MIN_BYTES = 256
+  COMPRESS_MIMETYPES = (
+    'text/', 'application/json', 'application/javascript',
+    'application/xml', 'image/svg+xml')
+
+  # Small static files are kept in RAM, with pre-rendered headers, up to
+  # a total of STATIC_CACHE_BYTES (0 disables). Cached files are checked
+  # for changes at most once every STATIC_CACHE_CHECK_MS.
+  STATIC_CACHE_BYTES = (8192 if IS_MICROPYTHON else 1024 * 1024)
+  STATIC_CACHE_MAX_FILE = (2048 if IS_MICROPYTHON else 64 * 1024)
+  STATIC_CACHE_CHECK_MS = 5000
+
+  # Remember how this many request paths map to files (or 404s), to avoid
+  # scanning directories on every request. See HTTPD.invalidate_caches().
+  PATH_CACHE_ENTRIES = (32 if IS_MICROPYTHON else 1024)
+
+  # Keep compiled code for this many .py pages, recompiling on change.
+  CODE_CACHE_ENTRIES = (4 if IS_MICROPYTHON else 64)
 
   WEBSOCKET_MASK = lambda: b'\0\0\0\0'
   WEBSOCKET_MAX_CONNS = (5 if IS_MICROPYTHON else 100)
@@ -324,17 +814,33 @@ class uPageKiteDefaults:
     return rs
 
   @classmethod
-  async def network_send_sleep(uPK, sent):
-    global SENT_COUNTER
-    global SENT_DELAYS
+  def make_rate_limiter(cls, bytes_per_sec):
+    if not bytes_per_sec:
+      return None
+    return cls.RATE_LIMITER(bytes_per_sec, cls.RATE_BURST_BYTES)
 
-    SENT_COUNTER += sent
-    if SENT_COUNTER > 100*1024*1024:
-      SENT_COUNTER = SENT_DELAYS = 0
+  @classmethod
+  def compressible(cls, mimetype):
+    if not (cls.TUNNEL_COMPRESSION and mimetype):
+      return False
+    for prefix in cls.COMPRESS_MIMETYPES:
+      if mimetype.startswith(prefix):
+        return True
+    return False
 
-    sleep_time = 5 + int((SENT_COUNTER * uPK.MS_DELAY_PER_BYTE) - SENT_DELAYS)
-    SENT_DELAYS += sleep_time
-    await fuzzy_sleep_ms(sleep_time)
+  @classmethod
+  def rate_limit_ms(cls, nbytes, limiters=()):
+    # How long to wait, after moving nbytes, to honor all our limits.
+    sleep_time = 0
+    for limiter in limiters:
+      if limiter is not None:
+        sleep_time = max(sleep_time, limiter.take(nbytes))
+    return sleep_time
+
+  @classmethod
+  async def network_send_sleep(cls, sent, limiters=()):
+    # Always yields, even if no rate limits apply.
+    await fuzzy_sleep_ms(cls.rate_limit_ms(sent, limiters))
 
   @classmethod
   async def check_fe_hint_url(cls):
@@ -475,23 +981,45 @@ class uPageKiteDefaults:
     data = bytes(data, 'utf-8') if isinstance(data, str) else data
     if cls.trace:
       cls.trace(']>[%d] %s' % (len(data), data[:24]))
+    if hasattr(conn, 'queue_write'):
+      # Anything the socket does not accept now gets sent on POLLOUT.
+      conn.queue_write(data)
+      conn.flush_writes()
+      return
     for chunk in range(0, len(data), cls.SEND_WINDOW_BYTES):
       conn.write(data[chunk:chunk+cls.SEND_WINDOW_BYTES])
     if hasattr(conn, 'flush'):
       conn.flush()
 
   @classmethod
-  async def send(cls, conn, data):
+  async def send(cls, conn, data, kite=None):
     data = bytes(data, 'utf-8') if isinstance(data, str) else data
-    for chunk in range(0, len(data), cls.SEND_WINDOW_BYTES):
-      # FIXME: Make this actually async!
-      conn.write(data[chunk:chunk+cls.SEND_WINDOW_BYTES])
-      await cls.network_send_sleep(min(len(data), cls.SEND_WINDOW_BYTES))
-    if hasattr(conn, 'flush'):
-      conn.flush()
+    limiters = (getattr(conn, 'limiter', None), kite and kite.limiter)
+    if hasattr(conn, 'queue_write'):
+      # Only this coroutine waits if the relay is slow; the tunnel reader
+      # and other streams keep running while the queue drains.
+      conn.queue_write(data)
+      while (not conn.flush_writes()) and (conn.wbytes > cls.SEND_QUEUE_BYTES):
+        await fuzzy_sleep_ms(5)
+      await cls.network_send_sleep(len(data), limiters)
+    else:
+      for chunk in range(0, len(data), cls.SEND_WINDOW_BYTES):
+        conn.write(data[chunk:chunk+cls.SEND_WINDOW_BYTES])
+        await cls.network_send_sleep(
+          min(len(data), cls.SEND_WINDOW_BYTES), limiters)
+      if hasattr(conn, 'flush'):
+        conn.flush()
     if cls.trace:
       cls.trace('>>[%d] %s' % (len(data), data[:24]))
 
+  @classmethod
+  async def drain(cls, conn):
+    deadline = ticks_add(ticks_ms(), 1000 * cls.SOCKET_TIMEOUTS[1])
+    while not conn.flush_writes():
+      if ticks_diff(ticks_ms(), deadline) > 0:
+        raise EofTunnelError('Timed out sending data')
+      await fuzzy_sleep_ms(5)
+
   @classmethod
   def fmt_chunk(cls, data):
     data = bytes(data, 'utf-8') if isinstance(data, str) else data
@@ -503,11 +1031,27 @@ class uPageKiteDefaults:
       bytes(frame.sid, 'latin-1'),
       bytes(data, 'utf-8') if isinstance(data, str) else data))
 
+  @classmethod
+  def fmt_data_parts(cls, frame, data):
+    """
+    Like fmt_data(), but returns a list of buffers: the chunk header, the
+    SID header and the payload itself, uncopied. The chunk header comes
+    first and stands alone, so it can be replaced if we compress.
+    """
+    data = bytes(data, 'utf-8') if isinstance(data, str) else data
+    sid_hdr = b'SID: %s\r\n\r\n' % (bytes(frame.sid, 'latin-1'),)
+    return [b'%x\r\n' % (len(sid_hdr) + len(data),), sid_hdr, data]
+
   @classmethod
   def fmt_eof(cls, frame):
     return cls.fmt_chunk(b'SID: %s\r\nEOF: 1WR\r\n\r\n' % (
       bytes(frame.sid, 'latin-1'),))
 
+  @classmethod
+  def fmt_skb(cls, sid, nbytes):
+    return cls.fmt_chunk(b'NOOP: 1\r\nSID: %s\r\nSKB: %d\r\n\r\n!' % (
+      bytes(sid, 'latin-1'), nbytes // 1024))
+
   @classmethod
   def fmt_pong(cls, pong):
     return cls.fmt_chunk(b'NOOP: 1\r\nPONG: %s\r\n\r\n!' % (
@@ -519,14 +1063,11 @@ class uPageKiteDefaults:
 
   @classmethod
   async def read_http_header(cls, conn):
-    header = bytes()
-    read_bytes = 1
     await fuzzy_sleep_ms(20)
-    while header[-4:] != b'\r\n\r\n':
-      byte = conn.read(1)
-      if byte in (b'', None):
-        raise EofTunnelError()
-      header += byte
+    try:
+      header = conn.read_http_header()
+    except OSError:
+      raise EofTunnelError()
     if cls.trace:
       cls.trace('<< %s' % header)
     await fuzzy_sleep_ms()
@@ -534,29 +1075,19 @@ class uPageKiteDefaults:
 
   @classmethod
   async def read_chunk(cls, conn):
-    hdr = b''
+    """
+    Read a single chunk from a TunnelStream, returning the payload as a
+    memoryview which is only valid until the next read.
+    """
     try:
-      while not hdr.endswith(b'\r\n') and len(hdr) < 10:
-        byte = conn.read(1)
-        if byte in (b'', None):
-          raise EofTunnelError()
-        hdr += byte
-
-      chunk_len = int(str(hdr, 'latin-1').strip(), 16)
-      payload = b''
-      while len(payload) < chunk_len:
-        payload += conn.read(chunk_len - len(payload))
-
-      if len(payload) != chunk_len:
-        raise EofTunnelError(
-          'Read size mismatch: %s != %s' % (len(payload), chunk_len))
+      hdr, payload = conn.read_chunk()
       if cls.trace:
-        cls.trace('<<[%d] %s %s' % (len(payload)+len(hdr), hdr, payload[:40]))
-
+        cls.trace('<<[%d] %s %s' % (
+          len(payload)+len(hdr), hdr, bytes(payload[:40])))
       return payload
-    except (UnicodeError, ValueError):
+    except (UnicodeError, ValueError) as e:
       if cls.debug:
-        cls.debug('Invalid chunk header: %s' % hdr)
+        cls.debug('%s' % e)
       raise EofTunnelError()
     except OSError:
       raise EofTunnelError()
@@ -588,6 +1119,15 @@ class uPageKiteDefaults:
       reqs.append('X-PageKite: %s:%s\r\n' % (data, sign))
     return ''.join(reqs)
 
+  @classmethod
+  def parse_features(cls, challenge):
+    features = []
+    for line in str(challenge, 'latin-1').splitlines():
+      if line.startswith('X-PageKite-Features:'):
+        features.extend(
+          f.strip() for f in line.split(':', 1)[1].split(','))
+    return features
+
   @classmethod
   def parse_challenge(cls, challenge, kites):
     ok = []
@@ -625,17 +1165,22 @@ class uPageKiteDefaults:
     cfd, conn = await sock_connect_stream(cls, relay_addr,
       ssl_wrap=cls.WITH_SSL,
       timeouts=cls.SOCKET_TIMEOUTS)
+    conn = TunnelStream(cls, cfd, conn)
     await cls.send(conn, (
         'CONNECT PageKite:1 HTTP/1.0\r\n'
         'X-PageKite-Features: AddKites\r\n'
+        '%s'
         'X-PageKite-Version: %s\r\n'
         '%s\r\n'
       ) % (
+        'X-PageKite-Features: ZChunks\r\n' if cls.TUNNEL_COMPRESSION else '',
         cls.APPVER,
         cls.x_pagekite(relay_addr, kites, global_secret)))
+    await cls.drain(conn)
 
     # Make sense of it...
     challenge = await cls.read_http_header(conn)
+    features = cls.parse_features(challenge)
     ok, needsign, rejected = cls.parse_challenge(challenge, kites)
     if rejected:
       conn.close()
@@ -647,7 +1192,9 @@ class uPageKiteDefaults:
           '%s\r\n'
         ) % (
           cls.x_pagekite(relay_addr, needsign, global_secret))))
-      challenge = await cls.read_chunk(conn)
+      await cls.drain(conn)
+      challenge = bytes(await cls.read_chunk(conn))
+      features += cls.parse_features(challenge)
       ok2, needsign, rejected = cls.parse_challenge(challenge, kites)
       ok += ok2
       if rejected or needsign:
@@ -658,8 +1205,12 @@ class uPageKiteDefaults:
       conn.close()
       raise RejectedError('No requests accepted, is this really a relay?')
 
+    if cls.TUNNEL_COMPRESSION and ('ZChunks' in features):
+      conn.enable_zchunks(cls.COMPRESS_LEVEL)
+
     if cls.info:
-      cls.info('Connected to %s' % (relay_addr,))
+      cls.info('Connected to %s%s' % (
+        relay_addr, ' (compressed)' if conn.deflate else ''))
 
     await fuzzy_sleep_ms()
     return cfd, conn
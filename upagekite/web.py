@@ -55,6 +55,42 @@ def process_post(max_bytes=None, _async=False, csrf=True):
   return decorate
 
 
+# Decorator for handlers which stream the request body (see RequestBody),
+# instead of having it buffered and parsed by process_post.
+def stream_body(max_bytes=None, _async=False):
+  def decorate(func):
+    def stream_wrapper(req_env):
+      func_attrs = req_env['url_func_attrs']
+      httpd = req_env['httpd']
+      # RequestBody counts bytes to find the end of the body, so it
+      # cannot handle chunked (or otherwise encoded) uploads.
+      if 'Transfer-Encoding' in req_env.http_headers:
+        req_env['send_http_response'](code=411, msg='Length Required')
+        return None
+      clen = int(req_env.http_headers.get('Content-Length', 0))
+      if max_bytes and (clen > max_bytes):
+        req_env['send_http_response'](code=400, msg='Too big')
+        return None
+      req_env['request_body'] = RequestBody(req_env)
+      async def handler():
+        try:
+          await httpd.run_handler(func, func_attrs, req_env)
+        except Exception as e:
+          if httpd.uPK.debug:
+            httpd.uPK.debug('stream_wrapper failed: %s(%s)' % (type(e), e))
+          req_env['send_http_response'](code=500, msg='Server Error')
+      # The handler waits for data which our caller must deliver, so it
+      # has to run as a task of its own.
+      asyncio.get_event_loop().create_task(handler())
+    if _async:
+      async def async_stream_wrapper(req_env):
+        return stream_wrapper(req_env)
+      return async_stream_wrapper
+    else:
+      return stream_wrapper
+  return decorate
+
+
 def _parse_basic_auth(data):
   return tuple(str(a2b_base64(data), 'utf-8').split(':', 1))
 
@@ -180,12 +216,17 @@ class PostVars(dict):
 
 
 class ParseNull():
-  def __init__(self, uPK, frame, headers, attrs):
+  # Incremental parsers consume frame.payload as data arrives, others
+  # are only run once the entire request body is available.
+  INCREMENTAL = False
+
+  def __init__(self, uPK, frame, headers, attrs, complete=True):
     self.uPK = uPK
     self.headers = headers
     self.frame = frame
     self.attrs = attrs
-    self.parse()
+    if complete or self.INCREMENTAL:
+      self.parse()
 
   def parse(self):
     pass
@@ -218,6 +259,77 @@ class ParseJSON(ParseNull):
         self.uPK.debug('%s parse failed: %s(%s)' % (self, type(e), e))
 
 
+class RequestBody:
+  """
+  An async iterator over the body of an HTTP request, yielding chunks of
+  data as they arrive. Consumed data is acknowledged, so the client (or
+  the relay) is slowed down if the handler cannot keep up. Use it with
+  the stream_body decorator:
+
+    @async_url('/upload')
+    @stream_body(_async=True)
+    async def upload(req_env):
+      async for data in req_env.request_body:
+        ...
+
+  Raises EOFError if the client disconnects before sending everything.
+  Chunked uploads are not supported, stream_body rejects them with 411.
+  """
+  def __init__(self, req_env):
+    frame = req_env['frame']
+    self.uPK = req_env['httpd'].uPK
+    self.conn = req_env['conn']
+    self.sid = frame.sid
+    self.chunks = []
+    self.event = asyncio.Event()
+
+    data = b''
+    if frame.payload:
+      data = frame.payload.split(b'\r\n\r\n', 1)[-1]
+      frame.payload = b''
+    if data:
+      self.chunks.append(data)
+    clen = int(req_env.http_headers.get('Content-Length', 0))
+    self.remaining = clen - len(data)
+    self.truncated = False
+    self.eof = (self.remaining <= 0)
+    if not self.eof:
+      self.conn.ack_data(self.sid, 0)
+      self.conn.async_await_data(
+        self.uPK, self.sid, self._on_data, self.remaining)
+
+  async def _on_data(self, frame):
+    if frame.noop:
+      return
+
+    data = frame.payload
+    if data:
+      self.chunks.append(data)
+      self.remaining -= len(data)
+    if (self.remaining <= 0) or (not data) or frame.eof:
+      self.truncated = (self.remaining > 0)
+      self.eof = True
+      if self.conn.handlers.get(self.sid) == self._on_data:
+        del self.conn.handlers[self.sid]
+    self.event.set()
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    while not self.chunks:
+      if self.eof:
+        if self.truncated:
+          raise EOFError('Request body truncated')
+        raise StopAsyncIteration()
+      self.event.clear()
+      await self.event.wait()
+    data = self.chunks.pop(0)
+    if not self.eof:
+      self.conn.ack_data(self.sid, len(data))
+    return data
+
+
 def handle_big_request(handler, env, max_bytes=None, _async=False, csrf=True):
   uPK = env['httpd'].uPK
   frame = env['frame']
@@ -270,7 +382,7 @@ def handle_big_request(handler, env, max_bytes=None, _async=False, csrf=True):
     return True
 
   headers['_post_data'] = PostVars()
-  parser = parser_cls(uPK, frame, headers, cattrs)
+  parser = parser_cls(uPK, frame, headers, cattrs, not needed_bytes)
   uPK.GC_COLLECT()
   if not needed_bytes:
     del parser
@@ -283,17 +395,28 @@ def handle_big_request(handler, env, max_bytes=None, _async=False, csrf=True):
 
   conn = env['conn']
   needed_bytes = [needed_bytes]  # Scope hack, nonlocal does not work
+
+  # Incremental parsers keep frame.payload short, otherwise we collect
+  # chunks and join them once at the end; repeated += is quadratic.
+  chunks = [] if parser.INCREMENTAL else [frame.payload]
   async def update_frame(frameN):
     nbytes = len(frameN.payload or '')
-    frame.payload += frameN.payload
-    needed_bytes[0] -= len(frameN.payload)
+    if parser.INCREMENTAL:
+      frame.payload += frameN.payload
+      parser.parse()
+    elif nbytes:
+      chunks.append(frameN.payload)
+    needed_bytes[0] -= nbytes
     del frameN
 
-    parser.parse()
     uPK.GC_COLLECT()
     if nbytes < 1 or needed_bytes[0] < 1:
       if frame.sid in conn.handlers:
         del conn.handlers[frame.sid]
+      if chunks:
+        frame.payload = b''.join(chunks)
+        del chunks[:]
+        parser.parse()
       if uPK.trace and frame.payload:
         uPK.trace('<<%s' % frame.payload)
       if check_csrf():
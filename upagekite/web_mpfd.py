@@ -8,34 +8,39 @@
 # Commercial licenses are for sale. See the files README.md and COPYING.txt
 # for more details.
 #
+from .proto import IS_MICROPYTHON
 from .web import PostVars, ParseNull, parse_hdr
 
-# This should be an efficient state machine for iterating over a buffer,
-# yielding each individual line for processing. Line lengths are capped
-# and the caller can define a list of strings to stop on.
-def _lines(payload, stop=(), maxlen=250, eol=b'\n'):
-  total = 0
-  try:
-    while True:
-      end = min(maxlen, payload[0][total:].index(eol))  # Raises ValueError
-      ln = payload[0][total:total+end+1]
-      yield ln
-      total += len(ln)
-      if ln in stop:
-        break
-  except ValueError:
-    pass
-  payload[0] = payload[0][total:]
-
 
 class ParseMPFD(ParseNull):
+  """
+  An incremental multipart/form-data parser. This is a state machine
+  which searches the buffer for the boundary directly, so long binary
+  uploads need not be split into lines. File parts are written to
+  temporary files in WRITE_BYTES blocks, other values kept in memory.
+  """
+  INCREMENTAL = True
   TEMP_FN = 0
+  MAX_HEADER_BYTES = 1024
+  WRITE_BYTES = (4 if IS_MICROPYTHON else 64) * 1024
+
+  PREAMBLE = 0
+  BOUNDARY = 1
+  HEADERS = 2
+  BODY = 3
+  DONE = 4
 
-  def __init__(self, *args):
-    self.in_header = True
+  def __init__(self, uPK, frame, headers, attrs, complete=True):
+    boundary = attrs.get('boundary')
+    self.delim = b'\r\n--' + bytes(boundary or '', 'latin-1')
+    self.state = self.PREAMBLE if boundary else self.DONE
     self.varname = None
-    self.payload = {'value': ''}
-    ParseNull.__init__(self, *args)  # Last, because parse() depends on the above
+    self.payload = None
+    self.chunks = []
+    self.wbuf = bytearray()
+    # The leading CRLF makes the first boundary look like the others
+    frame.payload = b'\r\n' + frame.payload
+    ParseNull.__init__(self, uPK, frame, headers, attrs, complete)
 
   def _tempfile(self):
     for path in ('/tmp', ''):
@@ -49,44 +54,96 @@ class ParseMPFD(ParseNull):
         pass
     raise
 
-  def parse(self):
-    post_data = self.headers['_post_data']
-    box = [self.frame.payload]
-    for line in _lines(box):
-      if self.uPK.trace:
-        self.uPK.trace('<<%s' % line)
+  def _start_part(self, hdrs):
+    if self.uPK.trace:
+      self.uPK.trace('<<%s' % hdrs)
+    self.varname = None
+    self.payload = {'value': ''}
+    for line in str(hdrs, 'utf-8').split('\r\n'):
+      if line.lower().startswith('content-disposition:'):
+        hval, hattrs = parse_hdr(line.split(':', 1)[1].strip())
+        self.varname = hattrs.get('name')
+        if 'filename' in hattrs:
+          self.payload['value'] = hattrs['filename']
+          self.payload['bytes'] = 0
+          self.payload.update(self._tempfile())
 
-      if (line[:2] == b'--') and line[2:].startswith(bytes(self.attrs['boundary'], 'latin-1')):
-        if 'fd' in self.payload:
-          self.payload['bytes'] -= 2
-          self.payload['fd'].close()
-          del self.payload['fd']
-        if self.varname:
-          if self.payload['value'].endswith('\r\n'):
-            self.payload['value'] = self.payload['value'][:-2]
-          post_data[self.varname] = self.payload
-        self.in_header = True
-        self.payload = {'value': ''}
+  def _flush(self):
+    if self.wbuf:
+      self.payload['fd'].write(self.wbuf)
+      self.wbuf = bytearray()
 
-      elif self.in_header:
-        if line in (b'\n', b'\r\n'):
-          self.in_header = False
+  def _data(self, buf, start, end):
+    if (end <= start) or (self.payload is None):
+      return
+    if 'fd' in self.payload:
+      self.payload['bytes'] += end - start
+      if (not self.wbuf) and (end - start >= self.WRITE_BYTES):
+        self.payload['fd'].write(memoryview(buf)[start:end])
+      else:
+        self.wbuf.extend(memoryview(buf)[start:end])
+        if len(self.wbuf) >= self.WRITE_BYTES:
+          self._flush()
+    else:
+      self.chunks.append(buf[start:end])
 
-        elif line.startswith(b'Content-Disposition:'):
-          hname, hval = str(line, 'utf-8').split(':', 1)
-          hval, hattrs = parse_hdr(hval.strip())
-          self.varname = hattrs['name']
-          if 'filename' in hattrs:
-            self.payload['value'] = hattrs['filename']
-            self.payload['bytes'] = 0
-            self.payload.update(self._tempfile())
+  def _end_part(self):
+    if self.payload is None:
+      return
+    if 'fd' in self.payload:
+      self._flush()
+      self.payload['fd'].close()
+      del self.payload['fd']
+    else:
+      self.payload['value'] = str(b''.join(self.chunks), 'utf-8')
+      self.chunks = []
+    if self.varname:
+      self.headers['_post_data'][self.varname] = self.payload
+    self.payload = None
 
-      else:
-        if 'bytes' in self.payload:
-          self.payload['bytes'] += len(line)
-        if 'fd' in self.payload:
-          self.payload['fd'].write(line)
-        else:
-          self.payload['value'] += str(line, 'utf-8')
+  def parse(self):
+    buf = self.frame.payload
+    pos = 0
+    dlen = len(self.delim)
+    try:
+      while self.state != self.DONE:
+        if self.state in (self.PREAMBLE, self.BODY):
+          i = buf.find(self.delim, pos)
+          if i < 0:
+            # Keep anything which might be the start of a boundary
+            keep = max(pos, len(buf) - dlen + 1)
+            if self.state == self.BODY:
+              self._data(buf, pos, keep)
+            pos = keep
+            break
+          if self.state == self.BODY:
+            self._data(buf, pos, i)
+            self._end_part()
+          pos = i + dlen
+          self.state = self.BOUNDARY
+
+        elif self.state == self.BOUNDARY:
+          if len(buf) - pos < 2:
+            break
+          if buf[pos:pos+2] == b'--':
+            self.state = self.DONE
+          else:
+            self.state = self.HEADERS
+
+        elif self.state == self.HEADERS:
+          # Note: the CRLF ending the boundary line starts the block
+          i = buf.find(b'\r\n\r\n', pos)
+          if i < 0:
+            if len(buf) - pos > self.MAX_HEADER_BYTES:
+              raise ValueError('Part headers too long')
+            break
+          self._start_part(buf[pos+2:i])
+          pos = i + 4
+          self.state = self.BODY
+
+    except Exception as e:
+      self.state = self.DONE
+      if self.uPK.debug:
+        self.uPK.debug('%s parse failed: %s(%s)' % (self, type(e), e))
 
-    self.frame.payload = box[0]
+    self.frame.payload = b'' if (self.state == self.DONE) else buf[pos:]
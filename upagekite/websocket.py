@@ -141,7 +141,7 @@ class Websocket(object):
       del self.streams[uid]
 
   async def receive_data(self, frame):
-    if frame.headers.get('NOOP'):
+    if frame.noop:
       return
 
     wss = self.streams.get(frame.uid)
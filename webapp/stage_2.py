@@ -33,7 +33,7 @@ else:
   CAPTIVE_IP = '192.168.4.1'
 
 
-@upagekite.httpd.url('/builtin', '/builtin/', _async=True)
+@upagekite.httpd.url('/builtin', _async=True)
 async def slash_builtin(env):
   return {
     'body': 'This is a built-in Python web endpoint\n',
@@ -41,7 +41,7 @@ async def slash_builtin(env):
     'ttl': 60}
 
 
-@upagekite.httpd.url('/builtin/big', '/builtin/big/')
+@upagekite.httpd.url('/builtin/big')
 def slash_builtin_big(env):
   chunks = 10240
   chunksize = 128  # Units of ten
@@ -55,7 +55,7 @@ def slash_builtin_big(env):
     yield bufr
 
 
-@upagekite.httpd.async_url('/websocket', '/websocket/')
+@upagekite.httpd.async_url('/websocket')
 @upagekite.websocket.websocket('test')
 async def ws_test(opcode, msg, conn, ws, first=False, eof=False, websocket=True):
   if not websocket: